@@ -1,36 +1,102 @@
+import functools
 import os
-import requests
+import shutil
+import threading
+import time
+import uuid
+from pathlib import Path
 
 import torch
 from PIL import Image
 from transformers import AutoProcessor, AutoModelForZeroShotObjectDetection
 from accelerate import Accelerator
 
+MODEL_ID = "IDEA-Research/grounding-dino-tiny"
+# Images per forward pass; panos are large, so this bounds activation memory
+DETECTION_BATCH_SIZE = 4
+# Each detection call writes its crops to a fresh run_<id> directory under
+# output_dir, so concurrent requests for the same pano never touch each
+# other's files. Run directories older than this are pruned.
+CROP_RETENTION_S = 15 * 60
 
-def run_object_detection(image_path, labels, output_dir="detected_crops", score_threshold=0.4, text_threshold=0.3):
-    model_id = "IDEA-Research/grounding-dino-tiny"
+
+# Threaded servers can hit the first request concurrently; one thread loads
+_detector_lock = threading.Lock()
+
+
+def _get_detector():
+    """(processor, model) for MODEL_ID, loaded once on first use"""
+    with _detector_lock:
+        return _load_detector()
+
+
+@functools.cache
+def _load_detector():
     device = Accelerator().device
-    processor = AutoProcessor.from_pretrained(model_id)
-    model = AutoModelForZeroShotObjectDetection.from_pretrained(model_id).to(device)
+    processor = AutoProcessor.from_pretrained(MODEL_ID)
+    model = AutoModelForZeroShotObjectDetection.from_pretrained(MODEL_ID).to(device).eval()
+    return processor, model
+
+
+def run_object_detection_batch(image_paths, labels, output_dir="detected_crops", score_threshold=0.4, text_threshold=0.3, on_crop=None):
+    """run_object_detection for several images, DETECTION_BATCH_SIZE per forward pass.
 
+    Returns one result dict per path, in order. Crops go to a run directory
+    of their own under output_dir, prefixed with the source image's stem so
+    crops from different images in the batch don't overwrite each other.
+    on_crop(crop_path, crop) is called with each saved crop's PIL image, so
+    callers can use it without reading it back.
+    """
+    if not image_paths:
+        return []  # don't load the detector for an empty request
+    processor, model = _get_detector()
     os.makedirs(output_dir, exist_ok=True)
-    image = Image.open(image_path).convert("RGB")
+    _prune_crop_runs(output_dir)
+    run_dir = os.path.join(output_dir, f"run_{uuid.uuid4().hex}")
+    os.makedirs(run_dir)
+    results = []
+    for start in range(0, len(image_paths), DETECTION_BATCH_SIZE):
+        paths = image_paths[start:start + DETECTION_BATCH_SIZE]
+        images = [Image.open(path).convert("RGB") for path in paths]
+        inputs = processor(images=images, text=[labels] * len(images), return_tensors="pt").to(model.device)
+        with torch.inference_mode():
+            outputs = model(**inputs)
+        detections = processor.post_process_grounded_object_detection(
+            outputs,
+            inputs.input_ids,
+            threshold=score_threshold,
+            text_threshold=text_threshold,
+            target_sizes=[image.size[::-1] for image in images]
+        )
+        for image_path, image, result in zip(paths, images, detections):
+            results.append(_save_crops(image_path, image, result, labels, run_dir, on_crop))
+    return results
+
+
+def _prune_crop_runs(output_dir):
+    """Delete run directories under output_dir older than CROP_RETENTION_S"""
+    cutoff = time.time() - CROP_RETENTION_S
+    with os.scandir(output_dir) as it:
+        for entry in it:
+            if not (entry.name.startswith("run_") and entry.is_dir()):
+                continue
+            try:
+                expired = entry.stat().st_mtime < cutoff
+            except FileNotFoundError:
+                continue  # another request pruned it first
+            if expired:
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def _save_crops(image_path, image, result, labels, output_dir, on_crop=None):
     W, H = image.size
-    text_labels = [labels]
-    inputs = processor(images=image, text=text_labels, return_tensors="pt").to(model.device)
-    with torch.no_grad():
-        outputs = model(**inputs)
-    results = processor.post_process_grounded_object_detection(
-        outputs,
-        inputs.input_ids,
-        threshold=score_threshold,
-        text_threshold=text_threshold,
-        target_sizes=[image.size[::-1]]
-    )
-    result = results[0]
+    stem = Path(image_path).stem
     crops = []
-    for idx, (box, score, label) in enumerate(zip(result["boxes"], result["scores"], result["labels"])):
-        box = [round(x, 2) for x in box.tolist()]
+    # One bulk conversion to Python floats instead of a tensor unwrap per box
+    boxes = result["boxes"].tolist()
+    scores = result["scores"].tolist()
+    for idx, (box, score, label) in enumerate(zip(boxes, scores, result["labels"])):
+        box = [round(x, 2) for x in box]
         xmin, ymin, xmax, ymax = map(int, box)
         xmin = max(0, xmin)
         ymin = max(0, ymin)
@@ -39,11 +105,13 @@ def run_object_detection(image_path, labels, output_dir="detected_crops", score_
         if xmax - xmin < 20 or ymax - ymin < 20:
             continue  # skip tiny crops
         crop = image.crop((xmin, ymin, xmax, ymax))
-        crop_path = os.path.join(output_dir, f"crop_{idx:03d}_{label}_s{score:.2f}.jpg")
+        crop_path = os.path.join(output_dir, f"{stem}_crop_{idx:03d}_{label}_s{score:.2f}.jpg")
         crop.save(crop_path)
+        if on_crop is not None:
+            on_crop(crop_path, crop)
         crops.append({
             "label": label,
-            "score": float(score),
+            "score": score,
             "box": box,
             "crop_path": crop_path
         })
@@ -53,4 +121,8 @@ def run_object_detection(image_path, labels, output_dir="detected_crops", score_
         "crops": crops,
         "num_crops": len(crops),
         "output_dir": output_dir
-    }
\ No newline at end of file
+    }
+
+
+def run_object_detection(image_path, labels, output_dir="detected_crops", score_threshold=0.4, text_threshold=0.3, on_crop=None):
+    return run_object_detection_batch([image_path], labels, output_dir, score_threshold, text_threshold, on_crop)[0]
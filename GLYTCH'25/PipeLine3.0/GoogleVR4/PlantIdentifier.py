@@ -0,0 +1,212 @@
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+import torch
+from PIL import Image
+from transformers import AutoImageProcessor, AutoModelForImageClassification
+
+try:
+    from .ObjectIdentifier import run_object_detection_batch
+except ImportError:  # imported top-level from GoogleVR4/, as app.py does
+    from ObjectIdentifier import run_object_detection_batch
+
+# Plant model for classification
+PLANT_MODEL_ID = "juppy44/plant-identification-2m-vit-b"
+DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+PLANT_BATCH_SIZE = 8  # crops per forward pass; bounds activation memory
+PLANT_TOP_K = 5
+# PLANT_TORCH_COMPILE=1 compiles the classifier's forward with torch.compile
+# when this torch has it; eager by default. The compiled forward is built for
+# one static shape, so batches are padded to PLANT_BATCH_SIZE, and it is
+# called by one thread at a time.
+PLANT_TORCH_COMPILE = os.getenv("PLANT_TORCH_COMPILE", "0") != "0" and hasattr(torch, "compile")
+# PLANT_INT8=1 serves the classifier's Linear layers as dynamic int8 on CPU
+# (GPU uses fp16). Off by default: check its top-5 labels against fp32 on
+# your own crops before turning it on.
+PLANT_INT8 = os.getenv("PLANT_INT8", "0") != "0"
+
+# JPEG decoding releases the GIL, so crops decode side by side
+crop_decode_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="crop-decode")
+
+
+# Threaded servers can hit the first request concurrently; one thread loads
+_plant_model_lock = threading.Lock()
+# Serializes calls into the compiled forward, which it shares across threads
+_compiled_forward_lock = threading.Lock()
+
+
+def _get_plant_model():
+    """(processor, model, device) for the plant classifier, loaded once on first use"""
+    with _plant_model_lock:
+        return _load_plant_model()
+
+
+@functools.cache
+def _load_plant_model():
+    processor = AutoImageProcessor.from_pretrained(PLANT_MODEL_ID)
+    model = AutoModelForImageClassification.from_pretrained(PLANT_MODEL_ID).to(DEVICE).eval()
+    if DEVICE.type == "cuda":
+        model = model.half()
+    elif PLANT_INT8:
+        # ViT compute is almost all Linear layers; int8 weights quarter their bytes
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    if PLANT_TORCH_COMPILE:
+        # No CUDA graphs ("reduce-overhead"): their output buffers are reused by
+        # the next replay, which threads sharing the model would race on
+        compiled = torch.compile(model, mode="default", dynamic=False)
+        # One dummy forward at the padded batch shape pays the compile cost here
+        # instead of on the first request
+        size = getattr(model.config, "image_size", 224)
+        try:
+            with torch.inference_mode():
+                compiled(pixel_values=torch.zeros(PLANT_BATCH_SIZE, 3, size, size, device=DEVICE, dtype=model.dtype))
+            model = compiled
+        except Exception as e:
+            print(f"torch.compile failed for the plant model, using eager mode: {e}")
+    return processor, model, DEVICE
+
+
+def classify_plant_batch(images: List[np.ndarray], top_k: int = PLANT_TOP_K) -> List[List[Dict[str, Any]]]:
+    """Top-k plant labels for each image, running PLANT_BATCH_SIZE images per forward pass"""
+    processor, model, device = _get_plant_model()
+    # torch.compile wraps the model in an OptimizedModule, which keeps the eager one as _orig_mod
+    compiled = hasattr(model, "_orig_mod")
+    id2label = model.config.id2label
+    results = []
+    for start in range(0, len(images), PLANT_BATCH_SIZE):
+        batch = images[start:start + PLANT_BATCH_SIZE]
+        inputs = processor(images=batch, return_tensors="pt")
+        # Pixel values follow the model's dtype (fp16 on GPU); ids stay integral
+        inputs = {
+            key: val.to(device, dtype=model.dtype) if val.is_floating_point() else val.to(device)
+            for key, val in inputs.items()
+        }
+        with torch.inference_mode():
+            if compiled:
+                # Zero-pad to the one shape the compiled forward was built for
+                pad = PLANT_BATCH_SIZE - len(batch)
+                inputs = {
+                    key: torch.cat([val, val.new_zeros((pad, *val.shape[1:]))]) if pad else val
+                    for key, val in inputs.items()
+                }
+                with _compiled_forward_lock:
+                    logits = model(**inputs).logits[:len(batch)].clone()
+            else:
+                logits = model(**inputs).logits.clone()
+        topk = torch.topk(logits.float().softmax(dim=-1), k=top_k, dim=-1)
+        # One device->host copy per batch instead of one .item() per prediction
+        for probs, idxs in zip(topk.values.tolist(), topk.indices.tolist()):
+            results.append([{"label": id2label[idx], "probability": prob} for prob, idx in zip(probs, idxs)])
+    return results
+
+
+@functools.cache
+def _plant_input_size() -> int:
+    """Edge length the plant processor resizes to; only the processor config is loaded"""
+    size = AutoImageProcessor.from_pretrained(PLANT_MODEL_ID).size
+    return size.get("shortest_edge") or min(size["height"], size["width"])
+
+
+def load_plant_image(path: str):
+    """HxWx3 RGB array for path, or the exception that stopped it from loading"""
+    try:
+        with Image.open(path) as image:
+            # JPEGs decode straight to the smallest DCT scale that still covers
+            # the processor's input size; other formats ignore draft()
+            edge = _plant_input_size()
+            image.draft("RGB", (edge, edge))
+            # The processor works on arrays, so convert here rather than in its loop
+            return np.asarray(image.convert("RGB"))
+    except Exception as e:
+        return e
+
+
+def load_plant_images(paths: List[str]) -> List[Any]:
+    """load_plant_image for each path, decoded concurrently on crop_decode_pool"""
+    return list(crop_decode_pool.map(load_plant_image, paths))
+
+
+def classify_crop_files(crop_paths: List[str], classify: Callable = classify_plant_batch) -> List[Dict[str, Any]]:
+    """
+    crop_classifications entries for crop_paths, classifying all readable
+    crops together. classify is classify_plant_batch or a drop-in that
+    spreads the batch elsewhere (the FastAPI server's process pool).
+    """
+    entries = [{"crop_image": path} for path in crop_paths]
+    loaded = []
+    for entry, image in zip(entries, load_plant_images(crop_paths)):
+        if isinstance(image, Exception):
+            entry["error"] = str(image)
+        else:
+            loaded.append((entry, image))
+    try:
+        results = classify([image for _, image in loaded])
+    except Exception as e:
+        for entry, _ in loaded:
+            entry["error"] = str(e)
+    else:
+        for (entry, _), result in zip(loaded, results):
+            entry["classification"] = result
+    return entries
+
+
+def detect_panos(images: List[Dict[str, Any]], labels: List[str]):
+    """
+    Object detection for pano_result images, batching every available pano
+    through run_object_detection_batch. Returns (detected_objects entry, crop
+    files to classify) per image; the crop files are the ones that pano's
+    detection saved, or None when the pano was skipped.
+    """
+    processed = [None] * len(images)
+    ready = []
+    for i, img in enumerate(images):
+        pano_path = img.get('pano_path')
+        if not img.get('pano_downloaded'):
+            processed[i] = {
+                'pano_id': img.get('id'),
+                'pano_path': pano_path,
+                'object_detection': 'Pano not downloaded.'
+            }, None
+        elif not pano_path or not os.path.isfile(pano_path):
+            # isfile, not exists: a directory here would fail its whole detection batch
+            processed[i] = {
+                'pano_id': img.get('id'),
+                'pano_path': pano_path,
+                'object_detection': 'Pano image not found.'
+            }, None
+        else:
+            ready.append(i)
+
+    # Images sharing a pano file are detected once
+    unique_paths = list(dict.fromkeys(os.path.abspath(images[i]['pano_path']) for i in ready))
+    if not unique_paths:
+        return processed  # nothing to detect; don't load the detector
+    detections = dict(zip(unique_paths, run_object_detection_batch(unique_paths, labels)))
+    for i in ready:
+        pano_path = images[i]['pano_path']
+        detect_result = detections[os.path.abspath(pano_path)]
+        processed[i] = {
+            'pano_id': images[i].get('id'),
+            'pano_path': pano_path,
+            'object_detection': detect_result
+        }, [crop['crop_path'] for crop in detect_result['crops']]
+    return processed
+
+
+def classify_pano_crops(processed, classify: Callable = classify_plant_batch) -> List[Dict[str, Any]]:
+    """classify_results for detect_panos outputs, with one classification pass over all panos' crops"""
+    per_pano = [(entry['pano_id'], crops) for entry, crops in processed if crops is not None]
+    # Panos sharing a file share crops; each crop is classified once
+    unique_paths = list(dict.fromkeys(path for _, crops in per_pano for path in crops))
+    classifications = dict(zip(unique_paths, classify_crop_files(unique_paths, classify)))
+    return [
+        {
+            'pano_id': pano_id,
+            'crop_classifications': [classifications[path] for path in crops]
+        }
+        for pano_id, crops in per_pano
+    ]
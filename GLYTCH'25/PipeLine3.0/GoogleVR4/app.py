@@ -1,20 +1,18 @@
-import glob
-
-from transformers import AutoImageProcessor, AutoModelForImageClassification
-from PIL import Image
-import torch
-
-# Load plant identification model once at startup
-PLANT_MODEL_ID = "juppy44/plant-identification-2m-vit-b"
-plant_processor = AutoImageProcessor.from_pretrained(PLANT_MODEL_ID)
-plant_model = AutoModelForImageClassification.from_pretrained(PLANT_MODEL_ID)
-
-
 from flask import Flask, request, jsonify
 import os
 import json
 import core
 from ObjectIdentifier import run_object_detection
+from PlantIdentifier import (
+    _get_plant_model,
+    classify_plant_batch,
+    classify_pano_crops,
+    detect_panos,
+    load_plant_image
+)
+
+# Load plant identification model once at startup
+_get_plant_model()
 
 app = Flask(__name__)
 
@@ -78,29 +76,7 @@ def panos_detect_objects_api():
         json.dump(pano_result, f, indent=2)
 
     # Step 2: For each pano image, run object detection
-    detected_objects = []
-    for img in pano_result.get('images', []):
-        if img.get('pano_downloaded'):
-            pano_path = img.get('pano_path')
-            if pano_path and os.path.exists(pano_path):
-                detect_result = run_object_detection(pano_path, labels)
-                detected_objects.append({
-                    'pano_id': img.get('id'),
-                    'pano_path': pano_path,
-                    'object_detection': detect_result
-                })
-            else:
-                detected_objects.append({
-                    'pano_id': img.get('id'),
-                    'pano_path': pano_path,
-                    'object_detection': 'Pano image not found.'
-                })
-        else:
-            detected_objects.append({
-                'pano_id': img.get('id'),
-                'pano_path': img.get('pano_path'),
-                'object_detection': 'Pano not downloaded.'
-            })
+    detected_objects = [entry for entry, _ in detect_panos(pano_result.get('images', []), labels)]
 
     # Step 3: Return combined result
     combined_result = {
@@ -116,16 +92,10 @@ def classify_plant_api():
     if not image_path or not os.path.exists(image_path):
         return jsonify({"error": "image_path not provided or file does not exist"}), 400
     try:
-        image = Image.open(image_path)
-        inputs = plant_processor(images=image, return_tensors="pt")
-        with torch.no_grad():
-            logits = plant_model(**inputs).logits
-        pred = logits.softmax(dim=-1)[0]
-        topk = torch.topk(pred, k=5)
-        results = []
-        for prob, idx in zip(topk.values, topk.indices):
-            label = plant_model.config.id2label[idx.item()]
-            results.append({"label": label, "probability": float(prob.item())})
+        image = load_plant_image(image_path)
+        if isinstance(image, Exception):
+            raise image
+        results = classify_plant_batch([image])[0]
         return jsonify({"results": results})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -152,63 +122,9 @@ def panos_detect_and_classify_api():
     os.makedirs(out_dir, exist_ok=True)
     result_path = os.path.join(out_dir, 'panos_detect_and_classify_result.json')
 
-    detected_objects = []
-    classify_results = []
-
-    for img in pano_result.get('images', []):
-        if img.get('pano_downloaded'):
-            pano_path = img.get('pano_path')
-            if pano_path and os.path.exists(pano_path):
-                detect_result = run_object_detection(pano_path, labels)
-                detected_objects.append({
-                    'pano_id': img.get('id'),
-                    'pano_path': pano_path,
-                    'object_detection': detect_result
-                })
-
-                # Step 2: For each detected crop, classify plant
-                crop_dir = os.path.join(os.path.dirname(pano_path), '..', 'detected_crops')
-                crop_dir = os.path.abspath(crop_dir)
-                crop_images = glob.glob(os.path.join(crop_dir, '*.jpg'))
-                crop_classifications = []
-                for crop_img in crop_images:
-                    # Internal call to classify_plant
-                    try:
-                        image = Image.open(crop_img)
-                        inputs = plant_processor(images=image, return_tensors="pt")
-                        with torch.no_grad():
-                            logits = plant_model(**inputs).logits
-                        pred = logits.softmax(dim=-1)[0]
-                        topk = torch.topk(pred, k=5)
-                        results = []
-                        for prob, idx in zip(topk.values, topk.indices):
-                            label = plant_model.config.id2label[idx.item()]
-                            results.append({"label": label, "probability": float(prob.item())})
-                        crop_classifications.append({
-                            "crop_image": crop_img,
-                            "classification": results
-                        })
-                    except Exception as e:
-                        crop_classifications.append({
-                            "crop_image": crop_img,
-                            "error": str(e)
-                        })
-                classify_results.append({
-                    'pano_id': img.get('id'),
-                    'crop_classifications': crop_classifications
-                })
-            else:
-                detected_objects.append({
-                    'pano_id': img.get('id'),
-                    'pano_path': pano_path,
-                    'object_detection': 'Pano image not found.'
-                })
-        else:
-            detected_objects.append({
-                'pano_id': img.get('id'),
-                'pano_path': img.get('pano_path'),
-                'object_detection': 'Pano not downloaded.'
-            })
+    processed = detect_panos(pano_result.get('images', []), labels)
+    detected_objects = [entry for entry, _ in processed]
+    classify_results = classify_pano_crops(processed)
 
     combined_result = {
         'pano_result': pano_result,
@@ -220,4 +136,4 @@ def panos_detect_and_classify_api():
     return jsonify(combined_result)
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    app.run(debug=True, threaded=True)
@@ -26,17 +26,22 @@ Outputs:
 
 import os
 import math
-import json
+import shutil
 import argparse
+import functools
 import time
-from typing import Optional, Dict, Any, List
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Any, List, Tuple
 from pathlib import Path
 
+import orjson
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 import cv2
 import numpy as np
+from cachetools import TTLCache
 from dotenv import load_dotenv
 
 # ---------------------------------------------------------------------
@@ -69,7 +74,9 @@ VIEWS_DIR.mkdir(parents=True, exist_ok=True)
 def create_session_with_retries(
     retries: int = 3,
     backoff_factor: float = 0.5,
-    timeout: int = 30
+    timeout: int = 30,
+    pool_connections: int = 10,
+    pool_maxsize: int = 10,
 ) -> requests.Session:
     """
     Create a requests session with automatic retry logic.
@@ -78,6 +85,8 @@ def create_session_with_retries(
         retries: Number of retries for failed requests
         backoff_factor: Sleep time between retries (backoff_factor * (2 ** retry_number))
         timeout: Default timeout for requests
+        pool_connections: Number of per-host connection pools to cache
+        pool_maxsize: Maximum keep-alive connections kept per host
     
     Returns:
         Configured requests.Session object
@@ -93,13 +102,41 @@ def create_session_with_retries(
         allowed_methods=["HEAD", "GET", "OPTIONS"]
     )
     
-    adapter = HTTPAdapter(max_retries=retry_strategy)
+    adapter = HTTPAdapter(
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        max_retries=retry_strategy,
+    )
     session.mount("http://", adapter)
     session.mount("https://", adapter)
     
     return session
 
 
+# Concurrent image downloads per pano request (see find_panos_and_views)
+PANO_FETCH_WORKERS = 8
+
+# Shared session for Mapillary API calls: keeps the TCP+TLS connection alive
+# between requests instead of handshaking on every query. The pool is sized
+# for the server's worker threads querying at once, so connections are
+# reused rather than discarded when it overflows.
+_session = create_session_with_retries(
+    retries=3, backoff_factor=1.0, timeout=30, pool_connections=4, pool_maxsize=16
+)
+_session.headers.update({
+    "Authorization": f"OAuth {MAPILLARY_TOKEN}",
+    "Accept-Encoding": "gzip",
+})
+# Image downloads come from Mapillary's CDN, so they get their own pool and
+# never carry the API token
+_download_session = create_session_with_retries(
+    retries=3, backoff_factor=1.0, timeout=30,
+    pool_connections=4, pool_maxsize=2 * PANO_FETCH_WORKERS,
+)
+# JPEG bytes don't compress further; skip gzip negotiation and decoding
+_download_session.headers["Accept-Encoding"] = "identity"
+
+
 # ---------------------------------------------------------------------
 # Geo helpers
 # ---------------------------------------------------------------------
@@ -122,27 +159,75 @@ def haversine_distance_m(lat1: float, lon1: float, lat2: float, lon2: float) ->
     return R * c
 
 
+def haversine_distances_m(
+    lat: float, lon: float, lats: np.ndarray, lons: np.ndarray
+) -> np.ndarray:
+    """
+    Vectorized haversine: distances in meters from (lat, lon) to each of (lats, lons).
+    """
+    R = 6371000.0  # Earth radius in meters
+
+    phi1 = math.radians(lat)
+    phi2 = np.radians(lats)
+
+    # Evaluated in place in two scratch buffers rather than allocating a new
+    # array per operation; the inputs are never modified.
+    # a = sin²(dphi/2) + cos(phi1)·cos(phi2)·sin²(dlambda/2)
+    a = np.subtract(phi2, phi1)
+    a *= 0.5
+    np.sin(a, out=a)
+    a *= a
+
+    b = np.subtract(lons, lon)
+    b *= 0.5 * _DEG_TO_RAD
+    np.sin(b, out=b)
+    b *= b
+    np.cos(phi2, out=phi2)
+    phi2 *= math.cos(phi1)
+    b *= phi2
+    a += b
+
+    # arcsin form: one sqrt and no arctan2; clip guards rounding past 1
+    np.minimum(a, 1.0, out=a)
+    np.sqrt(a, out=a)
+    np.arcsin(a, out=a)
+    a *= 2 * R
+    return a
+
+
+# 1 degree latitude ≈ 111.32 km
+_M_PER_DEG = 111_320.0
+_DEG_TO_RAD = math.pi / 180.0
+
+
+def _rank_dist_sq(
+    lats: np.ndarray, lons: np.ndarray, lat0: float, lon0: float
+) -> np.ndarray:
+    """
+    Squared equirectangular distance (m^2) from (lat0, lon0), on the same
+    sphere as haversine_distance_m. Within a few km it orders points like
+    haversine to well under a millimetre, with no per-point trig.
+    """
+    m_per_deg = 6371000.0 * _DEG_TO_RAD
+    dy = (lats - lat0) * m_per_deg
+    dx = (lons - lon0) * (m_per_deg * math.cos(lat0 * _DEG_TO_RAD))
+    return dx * dx + dy * dy
+
+
 def bbox_from_point(
     lat: float, lon: float, radius_m: float = 100.0
-) -> Dict[str, float]:
+) -> Tuple[float, float, float, float]:
     """
     Approximate bounding box (in degrees) around (lat, lon) for given radius (meters).
-    Returns dict with min_lat, max_lat, min_lon, max_lon.
+    Returns (min_lat, max_lat, min_lon, max_lon).
     """
-    # 1 degree latitude ≈ 111.32 km
-    delta_lat = radius_m / 111_320.0
+    delta_lat = radius_m / _M_PER_DEG
 
-    # 1 degree longitude ≈ 111.32 km * cos(latitude)
-    lat_rad = math.radians(lat)
-    meters_per_deg_lon = 111_320.0 * max(math.cos(lat_rad), 1e-6)
-    delta_lon = radius_m / meters_per_deg_lon
+    # 1 degree longitude ≈ 111.32 km * cos(latitude); adding epsilon instead
+    # of clamping with max() avoids a branch and only matters at the poles
+    delta_lon = delta_lat / (math.cos(lat * _DEG_TO_RAD) + 1e-6)
 
-    return {
-        "min_lat": lat - delta_lat,
-        "max_lat": lat + delta_lat,
-        "min_lon": lon - delta_lon,
-        "max_lon": lon + delta_lon,
-    }
+    return (lat - delta_lat, lat + delta_lat, lon - delta_lon, lon + delta_lon)
 
 
 # ---------------------------------------------------------------------
@@ -168,103 +253,104 @@ def select_well_distributed_images(
     if len(images) <= n:
         return images
     
-    # Start with the closest image to the center
-    selected = [images[0]]
-    remaining = images[1:]
+    lats = np.fromiter((img["lat"] for img in images), dtype=np.float64, count=len(images))
+    lons = np.fromiter((img["lon"] for img in images), dtype=np.float64, count=len(images))
+    return [images[i] for i in _select_well_distributed_indices(lats, lons, n, min_distance_m)]
+
+
+def _select_well_distributed_indices(
+    lats: np.ndarray, lons: np.ndarray, n: int, min_distance_m: float
+) -> List[int]:
+    """
+    select_well_distributed_images on coordinate arrays sorted by distance
+    from the center; returns indices of the picks in selection order.
+    """
+    # Start with the closest image to the center. min_dist[i] is the distance
+    # from image i to its nearest selected image, updated with one vectorized
+    # pass per pick instead of rescanning every selected/candidate pair.
+    selected_idx = [0]
+    min_dist = haversine_distances_m(lats[0], lons[0], lats, lons)
+    min_dist[0] = -np.inf  # Never pick an image twice
+    # min_dist only ever shrinks, so an image already within min_distance_m of
+    # a pick can never be chosen; drop it before the next haversine pass.
+    active = np.flatnonzero(min_dist >= min_distance_m)
     
-    while len(selected) < n and remaining:
-        # Find the image that maximizes the minimum distance to all selected images
-        best_candidate = None
-        best_min_dist = 0
-        best_idx = -1
+    while len(selected_idx) < n:
+        if active.size == 0:
+            print(f"  Note: Only found {len(selected_idx)} images with min separation of {min_distance_m}m")
+            break
         
-        for idx, candidate in enumerate(remaining):
-            # Calculate minimum distance to any already-selected image
-            min_dist_to_selected = min(
-                haversine_distance_m(
-                    candidate["lat"], candidate["lon"],
-                    sel["lat"], sel["lon"]
-                )
-                for sel in selected
-            )
-            
-            # Keep track of the candidate with the largest minimum distance
-            if min_dist_to_selected > best_min_dist:
-                best_min_dist = min_dist_to_selected
-                best_candidate = candidate
-                best_idx = idx
+        # The image that maximizes the minimum distance to all selected images
+        best_idx = int(active[np.argmax(min_dist[active])])
+        best_min_dist = min_dist[best_idx]
         
         # If the best candidate is too close (less than min_distance_m), stop
-        if best_min_dist < min_distance_m and len(selected) > 0:
-            print(f"  Note: Only found {len(selected)} images with min separation of {min_distance_m}m")
+        if best_min_dist < min_distance_m or best_min_dist <= 0:
+            print(f"  Note: Only found {len(selected_idx)} images with min separation of {min_distance_m}m")
             break
         
-        # Add the best candidate to selected images
-        if best_candidate:
-            selected.append(best_candidate)
-            remaining.pop(best_idx)
+        selected_idx.append(best_idx)
+        min_dist[active] = np.minimum(
+            min_dist[active],
+            haversine_distances_m(lats[best_idx], lons[best_idx], lats[active], lons[active]),
+        )
+        min_dist[best_idx] = -np.inf
+        active = active[min_dist[active] >= min_distance_m]
     
-    return selected
+    return selected_idx
 
 
 # ---------------------------------------------------------------------
 # Mapillary: get images within area of interest
 # ---------------------------------------------------------------------
-def find_nearest_vr_images(
+# Mapillary coverage is stable over minutes, so recent bbox queries are
+# reused. Keys snap the center to ~1 m (5 decimal places); failures are
+# never cached.
+_images_cache: TTLCache = TTLCache(maxsize=4096, ttl=600)
+# The bbox is built around the snapped center, so it is padded by more than
+# the worst-case snap offset (~0.8 m) to still cover every circle that shares
+# the key. Callers filter by distance from the exact point.
+_SNAP_PAD_M = 1.0
+_images_cache_lock = threading.Lock()
+
+
+def query_mapillary_images(
     lat: float,
     lon: float,
-    n: int = 5,
     radius_m: float = 100.0,
-    min_distance_m: float = 10.0,
     token: Optional[str] = None,
 ) -> List[Dict[str, Any]]:
     """
-    Query Mapillary v4 for well-distributed images within a circular area of interest.
-
-    Args:
-        lat: Center latitude
-        lon: Center longitude
-        n: Number of images to return
-        radius_m: Area of interest radius in meters (search within this circle)
-        min_distance_m: Minimum distance between selected images in meters
-        token: Mapillary API token
-        
-    Returns a list of dicts:
-      [
-        {
-          "id": <image_id>,
-          "lat": <image_lat>,
-          "lon": <image_lon>,
-          "distance_m": <distance>,
-          "viewer_url": "...",
-          "is_pano": <bool>,
-          "thumb_2048_url": <str | None>
-        },
-        ...
-      ]
-    Sorted by distance_m ascending, with good spatial distribution.
+    Raw Mapillary v4 image records inside the bbox around (lat, lon).
+    Returns [] if the request fails.
     """
     if token is None:
         token = MAPILLARY_TOKEN
 
-    bbox = bbox_from_point(lat, lon, radius_m=radius_m)
+    key_lat, key_lon = round(lat, 5), round(lon, 5)
+    cache_key = (key_lat, key_lon, radius_m, token)
+    with _images_cache_lock:
+        cached = _images_cache.get(cache_key)
+    if cached is not None:
+        print(f"Using cached Mapillary results for ({lat}, {lon}), {radius_m}m")
+        return cached
+
+    min_lat, max_lat, min_lon, max_lon = bbox_from_point(key_lat, key_lon, radius_m=radius_m + _SNAP_PAD_M)
 
     params = {
         # Ask for everything we need in one call
         "fields": "id,geometry,is_pano,thumb_2048_url,width,height",
-        "bbox": f"{bbox['min_lon']},{bbox['min_lat']},{bbox['max_lon']},{bbox['max_lat']}",
+        "bbox": f"{min_lon},{min_lat},{max_lon},{max_lat}",
         "limit": 2000,  # upper bound; API may cap it
     }
-    headers = {"Authorization": f"OAuth {token}"}
+    # The shared session already sends the default token
+    headers = {"Authorization": f"OAuth {token}"} if token != MAPILLARY_TOKEN else None
 
-    # Create session with retry logic
-    session = create_session_with_retries(retries=3, backoff_factor=1.0, timeout=30)
-    
     try:
         print(f"Querying Mapillary API for images within {radius_m}m of ({lat}, {lon})...")
-        resp = session.get(MAPILLARY_IMAGES_URL, params=params, headers=headers, timeout=30)
+        resp = _session.get(MAPILLARY_IMAGES_URL, params=params, headers=headers, timeout=(3.05, 30))
         resp.raise_for_status()
-        data = resp.json()
+        data = orjson.loads(resp.content)
         print(f"API request successful. Processing results...")
     except requests.exceptions.Timeout:
         print("ERROR: Request timed out. Please check your internet connection.")
@@ -284,29 +370,96 @@ def find_nearest_vr_images(
         elif resp.status_code == 403:
             print("Access forbidden. Your token may not have the required permissions.")
         return []
+    except orjson.JSONDecodeError as e:
+        print(f"ERROR: Mapillary returned a malformed response body: {e}")
+        return []
     except Exception as e:
         print(f"ERROR: Unexpected error while querying API: {e}")
         return []
-    finally:
-        session.close()
 
     images = data.get("data") or []
+    with _images_cache_lock:
+        _images_cache[cache_key] = images
+    return images
+
+
+def find_nearest_vr_images(
+    lat: float,
+    lon: float,
+    n: int = 5,
+    radius_m: float = 100.0,
+    min_distance_m: float = 10.0,
+    token: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Query Mapillary v4 for well-distributed images within a circular area of interest.
+
+    Args:
+        lat: Center latitude
+        lon: Center longitude
+        n: Number of images to return
+        radius_m: Area of interest radius in meters (search within this circle)
+        min_distance_m: Minimum distance between selected images in meters
+        token: Mapillary API token
+        
+    Returns a list of dicts:
+      [
+        {
+          "id": <image_id>,
+          "lat": <image_lat>,
+          "lon": <image_lon>,
+          "distance_m": <distance>,
+          "viewer_url": "...",
+          "is_pano": <bool>,
+          "thumb_2048_url": <str | None>
+        },
+        ...
+      ]
+    Sorted by distance_m ascending, with good spatial distribution.
+    """
+    images = query_mapillary_images(lat, lon, radius_m=radius_m, token=token)
+
+    # Skip records without usable coordinates up front
+    images = [
+        img for img in images
+        if len((img.get("geometry") or {}).get("coordinates") or ()) >= 2
+    ]
     if not images:
         return []
 
+    # Candidates are kept as coordinate arrays; dicts are only built below
+    # for the images that end up in the result
+    coords = np.fromiter(
+        (c for img in images for c in img["geometry"]["coordinates"][:2]),
+        dtype=np.float64,
+        count=2 * len(images),
+    ).reshape(-1, 2)
+    lons, lats = coords[:, 0], coords[:, 1]
+
+    # Cheap trig-free prefilter with 1% slack, then exact haversine for the
+    # survivors only
+    near = np.flatnonzero(_rank_dist_sq(lats, lons, lat, lon) <= (1.01 * radius_m) ** 2)
+    dists = np.full(len(images), np.inf)
+    dists[near] = haversine_distances_m(lat, lon, lats[near], lons[near])
+
+    # Filter: only include images within the circular area of interest,
+    # sorted by distance from center
+    within = near[dists[near] <= radius_m]
+    within = within[np.argsort(dists[within], kind="stable")]
+
+    print(f"Found {len(within)} total images in the area of interest")
+    
+    # Select well-distributed samples
+    if len(within) > n:
+        print(f"Selecting {n} well-distributed images (min {min_distance_m}m apart)...")
+        picks = _select_well_distributed_indices(lats[within], lons[within], n, min_distance_m)
+        within = within[picks]
+
     results: List[Dict[str, Any]] = []
-    for img in images:
-        geom = img.get("geometry") or {}
-        coords = geom.get("coordinates")
-        if not coords or len(coords) < 2:
-            continue
-
-        img_lon, img_lat = coords[0], coords[1]
-        dist = haversine_distance_m(lat, lon, img_lat, img_lon)
-        
-        # Filter: only include images within the circular area of interest
-        if dist > radius_m:
-            continue
+    for i in within:
+        img = images[i]
+        img_lon, img_lat = img["geometry"]["coordinates"][:2]
+        dist = float(dists[i])
 
         width = img.get("width")
         height = img.get("height")
@@ -334,23 +487,94 @@ def find_nearest_vr_images(
             }
         )
 
-    # Sort by distance from center
-    results.sort(key=lambda r: r["distance_m"])
-    
-    print(f"Found {len(results)} total images in the area of interest")
-    
-    # Select well-distributed samples
-    if len(results) > n:
-        print(f"Selecting {n} well-distributed images (min {min_distance_m}m apart)...")
-        selected = select_well_distributed_images(results, n, min_distance_m)
-        return selected
-    
     return results
 
 
 # ---------------------------------------------------------------------
 # 360 (equirectangular) → 4 normal views
 # ---------------------------------------------------------------------
+@functools.lru_cache(maxsize=8)
+def _unit_rays(out_w: int, out_h: int, fov_deg: float) -> np.ndarray:
+    """
+    Unit camera rays as a 3 x (out_h * out_w) float32 array of (x, y, z)
+    rows, for a pinhole camera looking down +Z. They only depend on the
+    output size and FOV.
+    """
+    fov = np.deg2rad(fov_deg)
+
+    # focal length in pixels
+    f = np.float32(0.5 * out_w / math.tan(fov / 2.0))
+
+    # A row and a column broadcast against each other instead of a meshgrid
+    xs = np.linspace(-out_w / 2.0, out_w / 2.0, out_w, dtype=np.float32)[None, :]
+    ys = -np.linspace(-out_h / 2.0, out_h / 2.0, out_h, dtype=np.float32)[:, None]  # flip Y to match image coordinates
+
+    # normalize direction vectors, written straight into one stacked array.
+    # Every operand is float32, so no step silently upcasts to float64.
+    inv_norm = xs * xs + ys * ys + f * f
+    np.sqrt(inv_norm, out=inv_norm)
+    np.reciprocal(inv_norm, out=inv_norm)
+    rays = np.empty((3, out_h, out_w), dtype=np.float32)
+    np.multiply(xs, inv_norm, out=rays[0])
+    np.multiply(ys, inv_norm, out=rays[1])
+    np.multiply(f, inv_norm, out=rays[2])
+
+    rays = rays.reshape(3, -1)
+    rays.setflags(write=False)  # Shared between cached callers
+    return rays
+
+
+@functools.lru_cache(maxsize=16)
+def _remap_tables(
+    w_in: int,
+    h_in: int,
+    out_w: int,
+    out_h: int,
+    fov_deg: float,
+    yaw_deg: float,
+    pitch_deg: float,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    cv2.remap tables (map_x, map_y) sampling a w_in x h_in equirectangular
+    pano for one view. Panos of the same size reuse the same tables.
+    """
+    rays = _unit_rays(out_w, out_h, fov_deg)
+    yaw = np.deg2rad(yaw_deg)
+    pitch = np.deg2rad(pitch_deg)
+
+    # pitch around X-axis, then yaw around Y-axis, folded into one matrix and
+    # applied to every ray with a single BLAS matmul
+    sin_pitch, cos_pitch = np.sin(pitch), np.cos(pitch)
+    sin_yaw, cos_yaw = np.sin(yaw), np.cos(yaw)
+    rot_pitch = np.array([
+        [1.0, 0.0, 0.0],
+        [0.0, cos_pitch, -sin_pitch],
+        [0.0, sin_pitch, cos_pitch],
+    ])
+    rot_yaw = np.array([
+        [cos_yaw, 0.0, sin_yaw],
+        [0.0, 1.0, 0.0],
+        [-sin_yaw, 0.0, cos_yaw],
+    ])
+    m = (rot_yaw @ rot_pitch).astype(np.float32)
+    x_y, y_y, z_y = (m @ rays).reshape(3, out_h, out_w)
+
+    # convert to spherical (lon, lat), then to equirectangular pixel coords.
+    # Each step writes into the matmul's output, so it is the only
+    # full-size allocation.
+    map_x = np.arctan2(x_y, z_y, out=x_y)          # lon in [-pi, pi]
+    map_x *= np.float32(w_in / (2 * np.pi))
+    map_x += np.float32(0.5 * w_in)
+
+    np.clip(y_y, -1.0, 1.0, out=y_y)
+    map_y = np.arcsin(y_y, out=y_y)                # lat in [-pi/2, pi/2]
+    map_y *= np.float32(-h_in / np.pi)
+    map_y += np.float32(0.5 * h_in)
+    map_x.setflags(write=False)
+    map_y.setflags(write=False)
+    return map_x, map_y
+
+
 def perspective_from_equirect(
     pano: np.ndarray,
     yaw_deg: float,
@@ -368,70 +592,129 @@ def perspective_from_equirect(
     fov_deg: horizontal field of view in degrees
     out_w, out_h: output resolution of the perspective image
     """
-    h_in, w_in = pano.shape[:2]
-    yaw = np.deg2rad(yaw_deg)
-    pitch = np.deg2rad(pitch_deg)
-    fov = np.deg2rad(fov_deg)
-
-    # focal length in pixels
-    f = 0.5 * out_w / math.tan(fov / 2.0)
-
-    xs = np.linspace(-out_w / 2.0, out_w / 2.0, out_w)
-    ys = np.linspace(-out_h / 2.0, out_h / 2.0, out_h)
-    x_grid, y_grid = np.meshgrid(xs, ys)
-
-    z = f * np.ones_like(x_grid)
-    x = x_grid
-    y = -y_grid  # flip Y to match image coordinates
+    return perspective_views_from_equirect(
+        pano, [yaw_deg], pitch_deg, fov_deg, out_w, out_h
+    )[0]
 
-    # normalize direction vectors
-    norm = np.sqrt(x * x + y * y + z * z)
-    x /= norm
-    y /= norm
-    z /= norm
 
-    # pitch around X-axis
-    sin_pitch, cos_pitch = np.sin(pitch), np.cos(pitch)
-    y_p = y * cos_pitch - z * sin_pitch
-    z_p = y * sin_pitch + z * cos_pitch
-    x_p = x
-
-    # yaw around Y-axis
-    sin_yaw, cos_yaw = np.sin(yaw), np.cos(yaw)
-    x_y = x_p * cos_yaw + z_p * sin_yaw
-    y_y = y_p
-    z_y = -x_p * sin_yaw + z_p * cos_yaw
-
-    # convert to spherical (lon, lat)
-    lon = np.arctan2(x_y, z_y)  # [-pi, pi]
-    lat = np.arcsin(y_y)        # [-pi/2, pi/2]
+def _stack_remap_tables(
+    w_in: int,
+    h_in: int,
+    out_w: int,
+    out_h: int,
+    fov_deg: float,
+    yaws_deg: Tuple[float, ...],
+    pitch_deg: float,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Float32 remap tables for several yaws stacked vertically, for one remap call."""
+    tables = [
+        _remap_tables(w_in, h_in, out_w, out_h, fov_deg, yaw, pitch_deg)
+        for yaw in yaws_deg
+    ]
+    # Stacked along rows so each view comes back as a contiguous block
+    map_x = np.vstack([t[0] for t in tables])
+    map_y = np.vstack([t[1] for t in tables])
+    return map_x, map_y
+
+
+@functools.lru_cache(maxsize=8)
+def _stacked_remap_tables(*table_key) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    _stack_remap_tables in OpenCV's fixed-point CV_16SC2 + CV_16UC1 form,
+    which remaps faster than float maps; conversion is paid once per pano size.
+    """
+    map1, map2 = cv2.convertMaps(*_stack_remap_tables(*table_key), cv2.CV_16SC2)
+    map1.setflags(write=False)
+    map2.setflags(write=False)
+    return map1, map2
+
+
+# Remap on the GPU when OpenCV was built with CUDA and a device is present;
+# the float tables stay resident on the device between panos.
+# Set PANO_CUDA_REMAP=0 to force the CPU path.
+CUDA_REMAP = (
+    os.getenv("PANO_CUDA_REMAP", "1") != "0"
+    and hasattr(cv2, "cuda")
+    and cv2.cuda.getCudaEnabledDeviceCount() > 0
+)
+
+
+@functools.lru_cache(maxsize=8)
+def _gpu_remap_tables(*table_key) -> Tuple[Any, Any]:
+    """_stack_remap_tables uploaded once as cv2.cuda_GpuMat (CUDA remap needs float maps)."""
+    gpu_maps = []
+    for table in _stack_remap_tables(*table_key):
+        gpu_map = cv2.cuda_GpuMat()
+        gpu_map.upload(table)
+        gpu_maps.append(gpu_map)
+    return tuple(gpu_maps)
+
+
+def perspective_views_from_equirect(
+    pano: np.ndarray,
+    yaws_deg: List[float],
+    pitch_deg: float,
+    fov_deg: float,
+    out_w: int,
+    out_h: int,
+) -> List[np.ndarray]:
+    """
+    Same as perspective_from_equirect for each yaw in yaws_deg, but renders all
+    views in a single remap so the pano is streamed through once.
+    """
+    h_in, w_in = pano.shape[:2]
+    table_key = (
+        w_in, h_in, out_w, out_h, float(fov_deg),
+        tuple(float(yaw) for yaw in yaws_deg), float(pitch_deg),
+    )
 
-    # spherical → equirectangular pixel coords
-    x_pano = (lon / (2 * np.pi) + 0.5) * w_in
-    y_pano = (0.5 - lat / np.pi) * h_in
+    if CUDA_REMAP:
+        gpu_map_x, gpu_map_y = _gpu_remap_tables(*table_key)
+        gpu_pano = cv2.cuda_GpuMat()
+        gpu_pano.upload(pano)
+        strip = cv2.cuda.remap(
+            gpu_pano, gpu_map_x, gpu_map_y,
+            interpolation=cv2.INTER_LINEAR, borderMode=cv2.BORDER_WRAP,
+        ).download()
+    else:
+        map1, map2 = _stacked_remap_tables(*table_key)
+        strip = cv2.remap(
+            pano, map1, map2, interpolation=cv2.INTER_LINEAR, borderMode=cv2.BORDER_WRAP
+        )
+    return np.vsplit(strip, len(yaws_deg))
 
-    map_x = x_pano.astype(np.float32)
-    map_y = y_pano.astype(np.float32)
 
-    perspective = cv2.remap(
-        pano, map_x, map_y, interpolation=cv2.INTER_LINEAR, borderMode=cv2.BORDER_WRAP
-    )
-    return perspective
+@functools.lru_cache(maxsize=16)
+def _decoded_pano(path_str: str, max_width: Optional[int] = None) -> np.ndarray:
+    """
+    Decoded pano pixels, kept for recently used panos since a pano's file
+    never changes once downloaded. Panos wider than max_width are shrunk with
+    INTER_AREA. Raises ValueError if it can't be decoded (errors are not cached).
+    """
+    pano = cv2.imread(path_str)
+    if pano is None:
+        raise ValueError(f"Could not load image {path_str}")
+    h, w = pano.shape[:2]
+    if max_width and w > max_width:
+        pano = cv2.resize(pano, (max_width, h * max_width // w), interpolation=cv2.INTER_AREA)
+    pano.setflags(write=False)  # Shared between cached callers
+    return pano
 
 
 def download_image(url: str, out_path: Path) -> None:
     """
     Download image from URL to out_path with retry logic.
     """
-    session = create_session_with_retries(retries=3, backoff_factor=1.0, timeout=30)
-    
+    # Written under a per-thread temporary name so an interrupted download is
+    # never mistaken for a cached pano, even with concurrent requests
+    part_path = out_path.with_name(f"{out_path.name}.{threading.get_ident()}.part")
     try:
-        r = session.get(url, stream=True, timeout=30)
-        r.raise_for_status()
-        with open(out_path, "wb") as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
+        with _download_session.get(url, stream=True, timeout=30) as r:
+            r.raise_for_status()
+            r.raw.decode_content = True  # In case the CDN encodes anyway
+            with open(part_path, "wb") as f:
+                shutil.copyfileobj(r.raw, f, 1 << 20)
+        os.replace(part_path, out_path)
         print(f"  Downloaded: {out_path.name}")
     except requests.exceptions.Timeout:
         print(f"  ERROR: Timeout downloading {out_path.name}")
@@ -440,7 +723,23 @@ def download_image(url: str, out_path: Path) -> None:
         print(f"  ERROR: Failed to download {out_path.name}: {e}")
         raise
     finally:
-        session.close()
+        part_path.unlink(missing_ok=True)
+
+
+# Shared by all requests; sized for the four views of one pano
+_view_writer = ThreadPoolExecutor(max_workers=4, thread_name_prefix="view-writer")
+
+
+# Views feed detection/classification; quality 85 is plenty for that and
+# much smaller and quicker to encode than OpenCV's default of 95
+VIEW_JPEG_PARAMS = [int(cv2.IMWRITE_JPEG_QUALITY), 85, int(cv2.IMWRITE_JPEG_OPTIMIZE), 0]
+
+
+def _write_view(out_path: Path, view: np.ndarray) -> None:
+    ok, buf = cv2.imencode(".jpg", view, VIEW_JPEG_PARAMS)
+    if not ok:
+        raise ValueError(f"Could not encode view {out_path.name}")
+    out_path.write_bytes(buf)
 
 
 def generate_4_views_for_pano(
@@ -462,32 +761,38 @@ def generate_4_views_for_pano(
     else:
         print(f"Using cached panorama {image_id}")
 
-    pano = cv2.imread(str(pano_path))
-    if pano is None:
-        print(f"  ERROR: Could not load image {pano_path}")
-        return {}
-
     print(f"  Generating 4 perspective views...")
     out_w, out_h = 800, 600
     fov_deg = 90.0
     pitch_deg = 0.0
+
+    # Each view spans fov/360 of the pano's width. Past out_w source pixels
+    # per view, remap only skips samples, so larger panos are shrunk first.
+    max_pano_w = int(math.ceil(out_w * 360.0 / fov_deg))
+    try:
+        pano = _decoded_pano(str(pano_path), max_pano_w)
+    except ValueError:
+        print(f"  ERROR: Could not load image {pano_path}")
+        return {}
+
     yaw_list = [0, 90, 180, 270]
     label_map = {0: "front", 90: "right", 180: "back", 270: "left"}
 
     out: Dict[str, str] = {}
 
-    for yaw in yaw_list:
-        view = perspective_from_equirect(
-            pano,
-            yaw_deg=yaw,
-            pitch_deg=pitch_deg,
-            fov_deg=fov_deg,
-            out_w=out_w,
-            out_h=out_h,
-        )
-        name = label_map.get(yaw, str(yaw))
-        out_path = out_views_dir / f"{image_id}_{name}.jpg"
-        cv2.imwrite(str(out_path), view)
+    views = perspective_views_from_equirect(
+        pano,
+        yaws_deg=yaw_list,
+        pitch_deg=pitch_deg,
+        fov_deg=fov_deg,
+        out_w=out_w,
+        out_h=out_h,
+    )
+    names = [label_map.get(yaw, str(yaw)) for yaw in yaw_list]
+    out_paths = [out_views_dir / f"{image_id}_{name}.jpg" for name in names]
+    # JPEG encoding releases the GIL, so the views are encoded in parallel
+    list(_view_writer.map(_write_view, out_paths, views))
+    for name, out_path in zip(names, out_paths):
         out[name] = str(out_path)
 
     print(f"  Generated: {', '.join(out.keys())}")
@@ -498,6 +803,65 @@ def generate_4_views_for_pano(
 # Main script logic
 # ---------------------------------------------------------------------
 
+# Downloads for the few images of one request run side by side
+_pano_pool = ThreadPoolExecutor(max_workers=PANO_FETCH_WORKERS, thread_name_prefix="pano-fetch")
+
+
+def _pano_result_entry(img: Dict[str, Any]) -> Dict[str, Any]:
+    """Download and split one selected image into its result entry."""
+    if not img["is_pano"]:
+        return {
+            "id": img["id"],
+            "lat": img["lat"],
+            "lon": img["lon"],
+            "distance_m": img["distance_m"],
+            "viewer_url": img["viewer_url"],
+            "is_pano": False,
+            "pano_downloaded": False,
+            "views": {},
+        }
+
+    image_id = img["id"]
+    image_url = img["thumb_2048_url"]
+    if not image_url:
+        return {
+            "id": image_id,
+            "lat": img["lat"],
+            "lon": img["lon"],
+            "distance_m": img["distance_m"],
+            "viewer_url": img["viewer_url"],
+            "is_pano": True,
+            "pano_downloaded": False,
+            "views": {},
+        }
+
+    try:
+        views = generate_4_views_for_pano(image_id, image_url, VIEWS_DIR)
+        return {
+            "id": image_id,
+            "lat": img["lat"],
+            "lon": img["lon"],
+            "distance_m": img["distance_m"],
+            "viewer_url": img["viewer_url"],
+            "is_pano": True,
+            "pano_downloaded": True,
+            "pano_path": str(PANOS_DIR / f"{image_id}.jpg"),
+            "views": views,  # dict: front/right/back/left -> file path
+        }
+    except Exception as e:
+        return {
+            "id": image_id,
+            "lat": img["lat"],
+            "lon": img["lon"],
+            "distance_m": img["distance_m"],
+            "viewer_url": img["viewer_url"],
+            "is_pano": True,
+            "pano_downloaded": False,
+            "views": {},
+            "error": str(e),
+        }
+
+
 # Flask-callable function
 def find_panos_and_views(lat, lon, n=3, radius_m=100.0, min_distance_m=10.0):
     images = find_nearest_vr_images(lat, lon, n=n, radius_m=radius_m, min_distance_m=min_distance_m)
@@ -522,69 +886,8 @@ def find_panos_and_views(lat, lon, n=3, radius_m=100.0, min_distance_m=10.0):
         "images": [],
     }
 
-    for img in images:
-        if not img["is_pano"]:
-            result_payload["images"].append(
-                {
-                    "id": img["id"],
-                    "lat": img["lat"],
-                    "lon": img["lon"],
-                    "distance_m": img["distance_m"],
-                    "viewer_url": img["viewer_url"],
-                    "is_pano": False,
-                    "pano_downloaded": False,
-                    "views": {},
-                }
-            )
-            continue
-
-        image_id = img["id"]
-        image_url = img["thumb_2048_url"]
-        if not image_url:
-            result_payload["images"].append(
-                {
-                    "id": image_id,
-                    "lat": img["lat"],
-                    "lon": img["lon"],
-                    "distance_m": img["distance_m"],
-                    "viewer_url": img["viewer_url"],
-                    "is_pano": True,
-                    "pano_downloaded": False,
-                    "views": {},
-                }
-            )
-            continue
-
-        try:
-            views = generate_4_views_for_pano(image_id, image_url, VIEWS_DIR)
-            result_payload["images"].append(
-                {
-                    "id": image_id,
-                    "lat": img["lat"],
-                    "lon": img["lon"],
-                    "distance_m": img["distance_m"],
-                    "viewer_url": img["viewer_url"],
-                    "is_pano": True,
-                    "pano_downloaded": True,
-                    "pano_path": str(PANOS_DIR / f"{image_id}.jpg"),
-                    "views": views,  # dict: front/right/back/left -> file path
-                }
-            )
-        except Exception as e:
-            result_payload["images"].append(
-                {
-                    "id": image_id,
-                    "lat": img["lat"],
-                    "lon": img["lon"],
-                    "distance_m": img["distance_m"],
-                    "viewer_url": img["viewer_url"],
-                    "is_pano": True,
-                    "pano_downloaded": False,
-                    "views": {},
-                    "error": str(e),
-                }
-            )
-
+    # Images are independent and mostly wait on the CDN, so fetch them concurrently
+    result_payload["images"] = list(_pano_pool.map(_pano_result_entry, images))
     return result_payload
 
 
@@ -1,16 +1,50 @@
 import sqlite3
+import threading
 import uuid
 import math
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Iterator, Tuple
+
+import numpy as np
 
 DB_PATH = Path(__file__).parent / "agnived.db"
+# Uploaded images live on disk; the uploads table only stores their path
+UPLOAD_DIR = Path(__file__).parent / "uploads"
+
+# Bump when init_db() gains a migration step; recorded in the schema_version table
+SCHEMA_VERSION = 2
+# Rows per query when iter_user_uploads pages through a user's uploads
+UPLOADS_PAGE_SIZE = 500
+
+# One connection per thread, reused across requests instead of reconnecting
+_local = threading.local()
+# All writes share one connection behind a lock, so threads queue in-process
+# instead of contending for SQLite's write lock and hitting SQLITE_BUSY
+_writer: Optional[sqlite3.Connection] = None
+_writer_lock = threading.Lock()
 
 
 def init_db() -> None:
     """Initialize SQLite database with tables and indexes."""
-    conn = sqlite3.connect(DB_PATH)
+    UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    # One transaction for all DDL and migrations, so concurrent workers booting
+    # at once run this one after another
+    with write_transaction() as conn:
+        _create_schema(conn)
+    print(f"✅ Database initialized at {DB_PATH}")
+
+
+def _create_schema(conn: sqlite3.Connection) -> None:
+    """Create tables and indexes, then apply migrations the database hasn't seen yet."""
     cur = conn.cursor()
+    existing_tables = {
+        row["name"] for row in cur.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    }
+    cur.execute("CREATE TABLE IF NOT EXISTS schema_version (v INTEGER PRIMARY KEY)")
+    version = cur.execute("SELECT COALESCE(MAX(v), 0) FROM schema_version").fetchone()[0]
+    # Fresh databases are created with the current schema and need no migrations
+    migrate = "uploads" in existing_tables and version < SCHEMA_VERSION
     
     # Users table
     cur.execute("""
@@ -33,46 +67,196 @@ def init_db() -> None:
             user_id TEXT NOT NULL,
             filename TEXT NOT NULL,
             content_type TEXT,
-            image BLOB NOT NULL,
+            path TEXT NOT NULL,
             latitude REAL NOT NULL,
             longitude REAL NOT NULL,
             species TEXT,
             created_at TEXT DEFAULT (datetime('now')),
+            rtree_id INTEGER,
             FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
         )
     """)
+    if migrate:
+        _migrate_upload_blobs_to_disk(conn)
+        _migrate_upload_rtree_ids(conn)
+    # uploads has a TEXT primary key, so its rowid is not stable (VACUUM may
+    # renumber it); the R*Tree is keyed by this column instead
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_uploads_rtree_id ON uploads(rtree_id)")
     cur.execute("CREATE INDEX IF NOT EXISTS idx_uploads_lat_lon ON uploads(latitude, longitude)")
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_uploads_user_id ON uploads(user_id)")
+    # Serves WHERE user_id = ? ORDER BY created_at DESC without a sort step, and
+    # plain user_id lookups as a prefix (latitude/longitude are NOT NULL, so no
+    # partial geo variant is needed)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_uploads_user_created ON uploads(user_id, created_at DESC)")
+    cur.execute("DROP INDEX IF EXISTS idx_uploads_user_id")
     cur.execute("CREATE INDEX IF NOT EXISTS idx_uploads_user_lat_lon ON uploads(user_id, latitude, longitude)")
     
-    conn.commit()
-    conn.close()
-    print(f"✅ Database initialized at {DB_PATH}")
+    # Spatial index: one degenerate box per upload, keyed by uploads.rtree_id
+    if migrate:
+        # Built from scratch: older versions keyed it by rowid, or never had it
+        cur.execute("DROP TABLE IF EXISTS uploads_rtree")
+    cur.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS uploads_rtree USING rtree(
+            id, min_lat, max_lat, min_lon, max_lon
+        )
+    """)
+    if migrate:
+        # Index existing uploads; new rows are added by insert_uploads()
+        cur.execute("""
+            INSERT INTO uploads_rtree (id, min_lat, max_lat, min_lon, max_lon)
+            SELECT rtree_id, latitude, latitude, longitude, longitude
+            FROM uploads
+        """)
+    
+    if version < SCHEMA_VERSION:
+        cur.execute("INSERT INTO schema_version (v) VALUES (?)", (SCHEMA_VERSION,))
+    
+    # Give the query planner statistics for the indexes above
+    cur.execute("ANALYZE")
 
 
-def get_connection() -> sqlite3.Connection:
-    """Get a connection to the database."""
-    conn = sqlite3.connect(DB_PATH)
+def _migrate_upload_blobs_to_disk(conn: sqlite3.Connection) -> None:
+    """Move images stored in the legacy uploads.image BLOB column into UPLOAD_DIR."""
+    columns = {row["name"] for row in conn.execute("PRAGMA table_info(uploads)")}
+    if "image" not in columns:
+        return
+    
+    # Runs inside init_db()'s transaction
+    if "path" not in columns:
+        conn.execute("ALTER TABLE uploads ADD COLUMN path TEXT")
+    
+    # Stream the rows off the cursor; the UPDATEs wait until the scan is done
+    updates = []
+    for row in conn.execute("SELECT rowid, id, filename FROM uploads WHERE path IS NULL"):
+        rel_path = upload_file_name(row["id"], row["filename"])
+        # Read one blob at a time instead of loading the whole table
+        blob = conn.execute("SELECT image FROM uploads WHERE rowid = ?", (row["rowid"],)).fetchone()["image"]
+        (UPLOAD_DIR / rel_path).write_bytes(blob)
+        updates.append((rel_path, row["rowid"]))
+    conn.executemany("UPDATE uploads SET path = ? WHERE rowid = ?", updates)
+    
+    conn.execute("ALTER TABLE uploads DROP COLUMN image")
+    print(f"✅ Moved {len(updates)} upload(s) from the database to {UPLOAD_DIR}")
+
+
+def _migrate_upload_rtree_ids(conn: sqlite3.Connection) -> None:
+    """Give every upload a stable rtree_id, seeded from its current rowid."""
+    columns = {row["name"] for row in conn.execute("PRAGMA table_info(uploads)")}
+    if "rtree_id" not in columns:
+        conn.execute("ALTER TABLE uploads ADD COLUMN rtree_id INTEGER")
+    conn.execute("UPDATE uploads SET rtree_id = rowid WHERE rtree_id IS NULL")
+
+
+def insert_uploads(uploads: List[Dict]) -> None:
+    """
+    Insert upload rows and their R*Tree entries in a single transaction.
+    
+    Each dict needs: id, user_id, filename, content_type, path, latitude,
+    longitude, species. Suitable for single uploads and bulk imports alike.
+    """
+    with write_transaction() as conn:
+        # New rows take rtree_ids above the current maximum (no concurrent writer under the lock)
+        last_id = conn.execute("SELECT COALESCE(MAX(rtree_id), 0) FROM uploads").fetchone()[0]
+        conn.executemany(
+            """
+            INSERT INTO uploads (id, user_id, filename, content_type, path, latitude, longitude, species, rtree_id)
+            VALUES (:id, :user_id, :filename, :content_type, :path, :latitude, :longitude, :species, :rtree_id)
+            """,
+            ({**upload, "rtree_id": last_id + i} for i, upload in enumerate(uploads, 1))
+        )
+        conn.execute("""
+            INSERT INTO uploads_rtree (id, min_lat, max_lat, min_lon, max_lon)
+            SELECT rtree_id, latitude, latitude, longitude, longitude
+            FROM uploads
+            WHERE rtree_id > ?
+        """, (last_id,))
+
+
+def upload_file_name(upload_id: str, filename: str) -> str:
+    """File name (relative to UPLOAD_DIR) for an upload, keeping only a safe extension."""
+    suffix = Path(filename).suffix.lower()
+    if not suffix[1:].isalnum():
+        suffix = ""
+    return f"{upload_id}{suffix}"
+
+
+def _configure_connection(conn: sqlite3.Connection) -> None:
+    """Apply per-connection settings once, when the connection is created."""
     conn.row_factory = sqlite3.Row  # Access columns by name
+    conn.execute("PRAGMA journal_mode=WAL")  # Readers don't block the writer
+    conn.execute("PRAGMA synchronous=NORMAL")  # Safe with WAL, fewer fsyncs
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-65536")  # 64 MB page cache
+    conn.execute("PRAGMA mmap_size=268435456")  # 256 MB memory-mapped I/O
+
+
+def get_connection() -> sqlite3.Connection:
+    """
+    Get this thread's connection to the database.
+
+    The connection is opened once per thread and reused, so callers must not
+    close it. It is meant for reads; writes go through write_transaction().
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH)
+        _configure_connection(conn)
+        _local.conn = conn
     return conn
 
 
+@contextmanager
+def write_transaction() -> Iterator[sqlite3.Connection]:
+    """
+    Run a write transaction on the shared writer connection.
+
+    Commits when the block exits normally and rolls back if it raises.
+    """
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = sqlite3.connect(DB_PATH, check_same_thread=False)
+            _configure_connection(_writer)
+        _writer.execute("BEGIN IMMEDIATE")  # Take SQLite's write lock up front
+        try:
+            yield _writer
+            _writer.commit()
+        except BaseException:
+            _writer.rollback()
+            raise
+
+
+def close_connection() -> None:
+    """Close this thread's connection and the shared writer, if open."""
+    global _writer
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        conn.execute("PRAGMA optimize")  # Refresh planner stats for what this connection queried
+        conn.close()
+        _local.conn = None
+    with _writer_lock:
+        if _writer is not None:
+            _writer.close()
+            _writer = None
+
+
 def generate_uuid() -> str:
     """Generate a UUID string."""
     return str(uuid.uuid4())
 
 
-def get_bounding_box(lat: float, lon: float, radius_km: float) -> Dict[str, float]:
-    """Calculate bounding box for a radius (in km)."""
-    lat_delta = radius_km / 111.32  # 1 degree latitude ≈ 111.32 km
-    lon_delta = radius_km / (111.32 * math.cos(math.radians(lat)))
+# 1 degree latitude ≈ 111.32 km
+_INV_KM_PER_DEG = 1.0 / 111.32
+_DEG_TO_RAD = math.pi / 180.0
+
+
+def get_bounding_box(lat: float, lon: float, radius_km: float) -> Tuple[float, float, float, float]:
+    """Calculate bounding box for a radius (in km) as (min_lat, max_lat, min_lon, max_lon)."""
+    lat_delta = radius_km * _INV_KM_PER_DEG
+    # Same pole guard as GoogleVR4.core.bbox_from_point: the epsilon keeps a
+    # query at the poles from dividing by zero
+    lon_delta = lat_delta / (math.cos(lat * _DEG_TO_RAD) + 1e-6)
     
-    return {
-        "min_lat": lat - lat_delta,
-        "max_lat": lat + lat_delta,
-        "min_lon": lon - lon_delta,
-        "max_lon": lon + lon_delta,
-    }
+    return (lat - lat_delta, lat + lat_delta, lon - lon_delta, lon + lon_delta)
 
 
 def haversine_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
@@ -90,6 +274,35 @@ def haversine_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> fl
     return R * c
 
 
+def haversine_distances(lat: float, lon: float, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    """Vectorized Haversine: distances in km from (lat, lon) to each of (lats, lons)."""
+    R = 6371  # Earth radius in km
+    
+    lat_rad = math.radians(lat)
+    lats_rad = np.radians(lats)
+    
+    # Evaluated in place in two scratch buffers; the inputs are never modified
+    a = np.subtract(lats_rad, lat_rad)
+    a *= 0.5
+    np.sin(a, out=a)
+    a *= a
+    
+    b = np.subtract(lons, lon)
+    b *= 0.5 * _DEG_TO_RAD
+    np.sin(b, out=b)
+    b *= b
+    np.cos(lats_rad, out=lats_rad)
+    lats_rad *= math.cos(lat_rad)
+    b *= lats_rad
+    a += b
+    
+    np.minimum(a, 1.0, out=a)  # Guards rounding past 1
+    np.sqrt(a, out=a)
+    np.arcsin(a, out=a)
+    a *= 2 * R
+    return a
+
+
 def get_uploads_in_radius(
     lat: float, 
     lon: float, 
@@ -99,7 +312,7 @@ def get_uploads_in_radius(
     """
     Get uploads within exact radius using two-step query (fast + precise).
     
-    Step 1: Fast bounding box query (uses lat/lon index)
+    Step 1: Fast bounding box query (uses the uploads_rtree spatial index)
     Step 2: Precise Haversine distance filter (in-memory)
     """
     bbox = get_bounding_box(lat, lon, radius_km)
@@ -107,47 +320,48 @@ def get_uploads_in_radius(
     conn = get_connection()
     cur = conn.cursor()
     
+    query = """
+        SELECT u.id, u.user_id, u.filename, u.content_type, u.latitude, u.longitude, u.species, u.created_at
+        FROM uploads_rtree r
+        JOIN uploads u ON u.rtree_id = r.id
+        WHERE r.max_lat >= ? AND r.min_lat <= ?
+          AND r.max_lon >= ? AND r.min_lon <= ?
+    """
+    params = list(bbox)  # min_lat, max_lat, min_lon, max_lon
+    
     if user_id:
-        # Query with user filter (uses idx_uploads_user_lat_lon)
-        cur.execute("""
-            SELECT id, user_id, filename, content_type, latitude, longitude, species, created_at
-            FROM uploads
-            WHERE user_id = ?
-              AND latitude BETWEEN ? AND ?
-              AND longitude BETWEEN ? AND ?
-        """, (user_id, bbox["min_lat"], bbox["max_lat"], bbox["min_lon"], bbox["max_lon"]))
-    else:
-        # Query all users (uses idx_uploads_lat_lon)
-        cur.execute("""
-            SELECT id, user_id, filename, content_type, latitude, longitude, species, created_at
-            FROM uploads
-            WHERE latitude BETWEEN ? AND ?
-              AND longitude BETWEEN ? AND ?
-        """, (bbox["min_lat"], bbox["max_lat"], bbox["min_lon"], bbox["max_lon"]))
+        query += " AND u.user_id = ?"
+        params.append(user_id)
+    
+    cur.execute(query, params)
     
     results = cur.fetchall()
-    conn.close()
-    
-    # Filter by exact Haversine distance
-    filtered = []
-    for row in results:
-        distance = haversine_distance(lat, lon, row["latitude"], row["longitude"])
-        if distance <= radius_km:
-            filtered.append({
-                "id": row["id"],
-                "user_id": row["user_id"],
-                "filename": row["filename"],
-                "content_type": row["content_type"],
-                "latitude": row["latitude"],
-                "longitude": row["longitude"],
-                "species": row["species"],
-                "created_at": row["created_at"],
-                "distance_km": round(distance, 2)
-            })
+    if not results:
+        return []
+    
+    # Filter by exact Haversine distance, computed for all candidates at once
+    lats = np.fromiter((row["latitude"] for row in results), dtype=np.float64, count=len(results))
+    lons = np.fromiter((row["longitude"] for row in results), dtype=np.float64, count=len(results))
+    distances = haversine_distances(lat, lon, lats, lons)
     
     # Sort by distance (nearest first)
-    filtered.sort(key=lambda x: x["distance_km"])
-    return filtered
+    within = np.flatnonzero(distances <= radius_km)
+    within = within[np.argsort(distances[within], kind="stable")]
+    
+    return [
+        {
+            "id": results[i]["id"],
+            "user_id": results[i]["user_id"],
+            "filename": results[i]["filename"],
+            "content_type": results[i]["content_type"],
+            "latitude": results[i]["latitude"],
+            "longitude": results[i]["longitude"],
+            "species": results[i]["species"],
+            "created_at": results[i]["created_at"],
+            "distance_km": round(float(distances[i]), 2)
+        }
+        for i in within
+    ]
 
 
 def get_user_score(user_id: str) -> int:
@@ -156,30 +370,50 @@ def get_user_score(user_id: str) -> int:
     cur = conn.cursor()
     cur.execute("SELECT COUNT(*) FROM uploads WHERE user_id = ?", (user_id,))
     score = cur.fetchone()[0]
-    conn.close()
     return score
 
 
-def get_user_uploads(user_id: str, limit: Optional[int] = None) -> List[Dict]:
-    """Get all uploads by a specific user."""
+def iter_user_uploads(user_id: str, limit: Optional[int] = None) -> Iterator[Dict]:
+    """
+    Yield uploads by a specific user, newest first, without materializing the list.
+
+    Rows are read UPLOADS_PAGE_SIZE at a time and each page's statement runs
+    to completion before any row is yielded. A slow consumer (a streaming
+    response) therefore never holds a statement open on this thread's
+    connection, which would pin its WAL read snapshot and hide newer writes
+    from every other query on that connection.
+    """
     conn = get_connection()
-    cur = conn.cursor()
-    
     query = """
         SELECT id, filename, content_type, latitude, longitude, species, created_at
         FROM uploads
-        WHERE user_id = ?
-        ORDER BY created_at DESC
+        WHERE user_id = ?{after}
+        ORDER BY created_at DESC, id DESC
+        LIMIT ?
     """
-    
-    if limit:
-        query += f" LIMIT {limit}"
-    
-    cur.execute(query, (user_id,))
-    results = cur.fetchall()
-    conn.close()
-    
-    return [dict(row) for row in results]
+    remaining = limit or None
+    after: Tuple = ()
+    while True:
+        page_size = min(UPLOADS_PAGE_SIZE, remaining) if remaining else UPLOADS_PAGE_SIZE
+        # Keyset pagination: continue strictly after the last row yielded
+        rows = conn.execute(
+            query.format(after=" AND (created_at, id) < (?, ?)" if after else ""),
+            (user_id, *after, page_size),
+        ).fetchall()
+        for row in rows:
+            yield dict(row)
+        if len(rows) < page_size:
+            return
+        if remaining:
+            remaining -= len(rows)
+            if not remaining:
+                return
+        after = (rows[-1]["created_at"], rows[-1]["id"])
+
+
+def get_user_uploads(user_id: str, limit: Optional[int] = None) -> List[Dict]:
+    """Get all uploads by a specific user."""
+    return list(iter_user_uploads(user_id, limit))
 
 
 if __name__ == "__main__":
@@ -1,30 +1,64 @@
-
-import glob
-from flask import Flask, request, jsonify
+from concurrent.futures import Future, ThreadPoolExecutor
+from flask import Flask, Response, request, jsonify
 from pathlib import Path
 import sys
 import traceback
 import os
 import json
-from PIL import Image
-import torch
-from transformers import AutoImageProcessor, AutoModelForImageClassification
+from typing import Any, Dict
+import orjson
 
 # Import the landcover pipeline
 from landcover.LandCover import AOIConfig as LandcoverAOIConfig, DownloadConfig, run_landcover_pipeline
 # Import the vegetation pipeline
-from vegetation.Vegetation_Classification_pipeline import AOIConfig as VegAOIConfig, run_bigearth_rdnet
+from vegetation.Vegetation_Classification_pipeline import AOIConfig as VegAOIConfig, fetch_bigearth_cube, run_bigearth_rdnet
 
 # GoogleVR4 imports
 import GoogleVR4.core as core
 from GoogleVR4.ObjectIdentifier import run_object_detection
+from GoogleVR4.PlantIdentifier import (
+    classify_plant_batch,
+    classify_pano_crops,
+    detect_panos,
+    load_plant_image
+)
 
 app = Flask(__name__)
 
-# Plant model for classification
-PLANT_MODEL_ID = "juppy44/plant-identification-2m-vit-b"
-plant_processor = AutoImageProcessor.from_pretrained(PLANT_MODEL_ID)
-plant_model = AutoModelForImageClassification.from_pretrained(PLANT_MODEL_ID)
+# Output locations, resolved once instead of on every request
+SERVER_DIR = Path(__file__).resolve().parent
+RESULT_OUT_DIR = SERVER_DIR / "out"
+RESULT_OUT_DIR.mkdir(exist_ok=True)
+LANDCOVER_RESULTS_DIR = SERVER_DIR / "LandcoverResults"
+
+# Independent pipeline stages (GEE downloads, pano search) run side by side here
+pipeline_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="pipeline")
+
+def discard_cube_when_done(cube_future: Future) -> None:
+    """Delete the cube a fetch_bigearth_cube future downloads, now or once the download finishes"""
+    def discard(future: Future) -> None:
+        if future.exception() is None:
+            future.result().unlink(missing_ok=True)
+    cube_future.add_done_callback(discard)
+
+# numpy scalars show up in the vegetation stats; non-str keys matched jsonify
+ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+def iter_combined_result_json(landcover: Dict[str, str], vegetation: Dict[str, Any], panos: Dict[str, Any]):
+    """
+    The run_landcover_vegetation_and_panos response as JSON chunks, with the
+    pano detection/classification lists written one item at a time so the
+    whole body is never held as a single bytes object.
+    """
+    yield b'{"landcover":' + orjson.dumps(landcover)
+    yield b',"vegetation":' + orjson.dumps(vegetation, option=ORJSON_OPTIONS, default=str)
+    yield b',"panos":{"pano_result":' + orjson.dumps(panos['pano_result'], option=ORJSON_OPTIONS, default=str)
+    for key in ('detected_objects', 'classify_results'):
+        yield b',"' + key.encode() + b'":['
+        for i, item in enumerate(panos[key]):
+            yield (b',' if i else b'') + orjson.dumps(item, option=ORJSON_OPTIONS, default=str)
+        yield b']'
+    yield b'}}'
 
 @app.route('/panos', methods=['POST'])
 def panos_api():
@@ -43,9 +77,7 @@ def panos_api():
         min_distance_m=min_distance
     )
     # Save result to out/panos_result.json
-    out_dir = os.path.join(os.path.dirname(__file__), 'out')
-    os.makedirs(out_dir, exist_ok=True)
-    result_path = os.path.join(out_dir, 'panos_result.json')
+    result_path = RESULT_OUT_DIR / 'panos_result.json'
     with open(result_path, 'w', encoding='utf-8') as f:
         json.dump(result, f, indent=2)
     return jsonify(result)
@@ -78,36 +110,12 @@ def panos_detect_objects_api():
         min_distance_m=min_distance
     )
     # Save pano result JSON
-    out_dir = os.path.join(os.path.dirname(__file__), 'out')
-    os.makedirs(out_dir, exist_ok=True)
-    result_path = os.path.join(out_dir, 'panos_detect_objects_result.json')
+    result_path = RESULT_OUT_DIR / 'panos_detect_objects_result.json'
     with open(result_path, 'w', encoding='utf-8') as f:
         json.dump(pano_result, f, indent=2)
 
     # Step 2: For each pano image, run object detection
-    detected_objects = []
-    for img in pano_result.get('images', []):
-        if img.get('pano_downloaded'):
-            pano_path = img.get('pano_path')
-            if pano_path and os.path.exists(pano_path):
-                detect_result = run_object_detection(pano_path, labels)
-                detected_objects.append({
-                    'pano_id': img.get('id'),
-                    'pano_path': pano_path,
-                    'object_detection': detect_result
-                })
-            else:
-                detected_objects.append({
-                    'pano_id': img.get('id'),
-                    'pano_path': pano_path,
-                    'object_detection': 'Pano image not found.'
-                })
-        else:
-            detected_objects.append({
-                'pano_id': img.get('id'),
-                'pano_path': img.get('pano_path'),
-                'object_detection': 'Pano not downloaded.'
-            })
+    detected_objects = [entry for entry, _ in detect_panos(pano_result.get('images', []), labels)]
 
     # Step 3: Return combined result
     combined_result = {
@@ -123,16 +131,10 @@ def classify_plant_api():
     if not image_path or not os.path.exists(image_path):
         return jsonify({"error": "image_path not provided or file does not exist"}), 400
     try:
-        image = Image.open(image_path)
-        inputs = plant_processor(images=image, return_tensors="pt")
-        with torch.no_grad():
-            logits = plant_model(**inputs).logits
-        pred = logits.softmax(dim=-1)[0]
-        topk = torch.topk(pred, k=5)
-        results = []
-        for prob, idx in zip(topk.values, topk.indices):
-            label = plant_model.config.id2label[idx.item()]
-            results.append({"label": label, "probability": float(prob.item())})
+        image = load_plant_image(image_path)
+        if isinstance(image, Exception):
+            raise image
+        results = classify_plant_batch([image])[0]
         return jsonify({"results": results})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -155,67 +157,11 @@ def panos_detect_and_classify_api():
         radius_m=area_of_interest,
         min_distance_m=min_distance
     )
-    out_dir = os.path.join(os.path.dirname(__file__), 'out')
-    os.makedirs(out_dir, exist_ok=True)
-    result_path = os.path.join(out_dir, 'panos_detect_and_classify_result.json')
-
-    detected_objects = []
-    classify_results = []
-
-    for img in pano_result.get('images', []):
-        if img.get('pano_downloaded'):
-            pano_path = img.get('pano_path')
-            if pano_path and os.path.exists(pano_path):
-                detect_result = run_object_detection(pano_path, labels)
-                detected_objects.append({
-                    'pano_id': img.get('id'),
-                    'pano_path': pano_path,
-                    'object_detection': detect_result
-                })
+    result_path = RESULT_OUT_DIR / 'panos_detect_and_classify_result.json'
 
-                # Step 2: For each detected crop, classify plant
-                crop_dir = os.path.join(os.path.dirname(pano_path), '..', 'detected_crops')
-                crop_dir = os.path.abspath(crop_dir)
-                crop_images = glob.glob(os.path.join(crop_dir, '*.jpg'))
-                crop_classifications = []
-                for crop_img in crop_images:
-                    # Internal call to classify_plant
-                    try:
-                        image = Image.open(crop_img)
-                        inputs = plant_processor(images=image, return_tensors="pt")
-                        with torch.no_grad():
-                            logits = plant_model(**inputs).logits
-                        pred = logits.softmax(dim=-1)[0]
-                        topk = torch.topk(pred, k=5)
-                        results = []
-                        for prob, idx in zip(topk.values, topk.indices):
-                            label = plant_model.config.id2label[idx.item()]
-                            results.append({"label": label, "probability": float(prob.item())})
-                        crop_classifications.append({
-                            "crop_image": crop_img,
-                            "classification": results
-                        })
-                    except Exception as e:
-                        crop_classifications.append({
-                            "crop_image": crop_img,
-                            "error": str(e)
-                        })
-                classify_results.append({
-                    'pano_id': img.get('id'),
-                    'crop_classifications': crop_classifications
-                })
-            else:
-                detected_objects.append({
-                    'pano_id': img.get('id'),
-                    'pano_path': pano_path,
-                    'object_detection': 'Pano image not found.'
-                })
-        else:
-            detected_objects.append({
-                'pano_id': img.get('id'),
-                'pano_path': img.get('pano_path'),
-                'object_detection': 'Pano not downloaded.'
-            })
+    processed = detect_panos(pano_result.get('images', []), labels)
+    detected_objects = [entry for entry, _ in processed]
+    classify_results = classify_pano_crops(processed)
 
     combined_result = {
         'pano_result': pano_result,
@@ -237,11 +183,9 @@ def run_landcover():
         date_end = data.get('date_end', '2024-11-15')
         scale = int(data.get('scale', 10))
         cloud_cover_max = int(data.get('cloud_cover_max', 20))
-        parent_dir = Path(__file__).resolve().parent
-        results_dir = parent_dir / "LandcoverResults"
         aoi_cfg = LandcoverAOIConfig(lon=lon, lat=lat, buffer_km=buffer_km)
         dl_cfg = DownloadConfig(
-            output_dir=results_dir,
+            output_dir=LANDCOVER_RESULTS_DIR,
             date_start=date_start,
             date_end=date_end,
             scale=scale,
@@ -262,13 +206,11 @@ def run_vegetation():
         mask_path = data.get('mask_path')
         if not mask_path:
             # Default to LandcoverResults/vegetation_mask.tif in parent dir
-            parent_dir = Path(__file__).resolve().parent
-            mask_path = parent_dir / "LandcoverResults" / "vegetation_mask.tif"
+            mask_path = LANDCOVER_RESULTS_DIR / "vegetation_mask.tif"
         aoi_cfg = VegAOIConfig(lon=lon, lat=lat, buffer_km=buffer_km)
         res = run_bigearth_rdnet(aoi_cfg, veg_mask_path=Path(mask_path))
         result = {
             'aoi': vars(res.aoi) if hasattr(res.aoi, '__dict__') else str(res.aoi),
-            'cube_path': str(res.cube_path),
             'viz_path': str(res.viz_path),
             'class_distribution': res.class_distribution,
             'tile_counts': res.tile_counts,
@@ -289,25 +231,28 @@ def run_landcover_and_vegetation():
         date_end = data.get('date_end', '2024-11-15')
         scale = int(data.get('scale', 10))
         cloud_cover_max = int(data.get('cloud_cover_max', 20))
-        parent_dir = Path(__file__).resolve().parent
-        results_dir = parent_dir / "LandcoverResults"
         # Landcover pipeline
         aoi_cfg = LandcoverAOIConfig(lon=lon, lat=lat, buffer_km=buffer_km)
         dl_cfg = DownloadConfig(
-            output_dir=results_dir,
+            output_dir=LANDCOVER_RESULTS_DIR,
             date_start=date_start,
             date_end=date_end,
             scale=scale,
             cloud_cover_max=cloud_cover_max,
         )
-        landcover_outputs = run_landcover_pipeline(aoi_cfg, dl_cfg)
-        # Vegetation pipeline (use mask from landcover output)
-        mask_path = landcover_outputs.get('vegetation_mask')
+        # The vegetation cube does not need the mask, so download it during landcover
         veg_aoi_cfg = VegAOIConfig(lon=lon, lat=lat, buffer_km=buffer_km)
-        veg_res = run_bigearth_rdnet(veg_aoi_cfg, veg_mask_path=Path(mask_path))
+        cube_future = pipeline_executor.submit(fetch_bigearth_cube, veg_aoi_cfg)
+        try:
+            landcover_outputs = run_landcover_pipeline(aoi_cfg, dl_cfg)
+            # Vegetation pipeline (use mask from landcover output)
+            mask_path = landcover_outputs.get('vegetation_mask')
+            veg_res = run_bigearth_rdnet(veg_aoi_cfg, veg_mask_path=Path(mask_path), cube_path=cube_future.result())
+        finally:
+            # The prefetched cube is this request's to clean up, whatever happened
+            discard_cube_when_done(cube_future)
         veg_result = {
             'aoi': vars(veg_res.aoi) if hasattr(veg_res.aoi, '__dict__') else str(veg_res.aoi),
-            'cube_path': str(veg_res.cube_path),
             'viz_path': str(veg_res.viz_path),
             'class_distribution': veg_res.class_distribution,
             'tile_counts': veg_res.tile_counts,
@@ -333,107 +278,68 @@ def run_landcover_vegetation_and_panos():
         date_end = data.get('date_end', '2024-11-15')
         scale = int(data.get('scale', 10))
         cloud_cover_max = int(data.get('cloud_cover_max', 20))
-        parent_dir = Path(__file__).resolve().parent
-        results_dir = parent_dir / "LandcoverResults"
         aoi_cfg = LandcoverAOIConfig(lon=lon, lat=lat, buffer_km=buffer_km)
         dl_cfg = DownloadConfig(
-            output_dir=results_dir,
+            output_dir=LANDCOVER_RESULTS_DIR,
             date_start=date_start,
             date_end=date_end,
             scale=scale,
             cloud_cover_max=cloud_cover_max,
         )
-        landcover_outputs = run_landcover_pipeline(aoi_cfg, dl_cfg)
-        mask_path = landcover_outputs.get('vegetation_mask')
+        # Panos detect & classify: area_of_interest < 150m
+        panos_lat = float(data.get('panos_lat', lat))
+        panos_lon = float(data.get('panos_lon', lon))
+        panos_count = int(data.get('panos_count', 3))
+        panos_area_of_interest = float(data.get('panos_area_of_interest', 100))  # force < 150m
+        panos_min_distance = float(data.get('panos_min_distance', 20))
+        panos_labels = data.get('panos_labels', ['tree', 'bushes'])
+
+        def detect_and_classify_panos():
+            pano_result = core.find_panos_and_views(
+                lat=panos_lat,
+                lon=panos_lon,
+                n=panos_count,
+                radius_m=panos_area_of_interest,
+                min_distance_m=panos_min_distance
+            )
+            processed = detect_panos(pano_result.get('images', []), panos_labels)
+            return {
+                'pano_result': pano_result,
+                'detected_objects': [entry for entry, _ in processed],
+                'classify_results': classify_pano_crops(processed)
+            }
+
+        # Panos don't depend on landcover/vegetation, so the request takes the
+        # longer of the two instead of their sum
+        panos_future = pipeline_executor.submit(detect_and_classify_panos)
+        # The vegetation cube does not need the mask, so download it during landcover
         veg_aoi_cfg = VegAOIConfig(lon=lon, lat=lat, buffer_km=buffer_km)
-        veg_res = run_bigearth_rdnet(veg_aoi_cfg, veg_mask_path=Path(mask_path))
+        cube_future = pipeline_executor.submit(fetch_bigearth_cube, veg_aoi_cfg)
+        try:
+            landcover_outputs = run_landcover_pipeline(aoi_cfg, dl_cfg)
+            mask_path = landcover_outputs.get('vegetation_mask')
+            veg_res = run_bigearth_rdnet(veg_aoi_cfg, veg_mask_path=Path(mask_path), cube_path=cube_future.result())
+        finally:
+            # The prefetched cube is this request's to clean up, whatever happened
+            discard_cube_when_done(cube_future)
         veg_result = {
             'aoi': vars(veg_res.aoi) if hasattr(veg_res.aoi, '__dict__') else str(veg_res.aoi),
-            'cube_path': str(veg_res.cube_path),
             'viz_path': str(veg_res.viz_path),
             'class_distribution': veg_res.class_distribution,
             'tile_counts': veg_res.tile_counts,
             'avg_confidence': veg_res.avg_confidence,
         }
-        # Panos detect & classify: area_of_interest < 150m
-        panos_lat = float(data.get('panos_lat', lat))
-        panos_lon = float(data.get('panos_lon', lon))
-        panos_count = int(data.get('panos_count', 3))
-        panos_area_of_interest = float(data.get('panos_area_of_interest', 100))  # force < 150m
-        panos_min_distance = float(data.get('panos_min_distance', 20))
-        panos_labels = data.get('panos_labels', ['tree', 'bushes'])
-        pano_result = core.find_panos_and_views(
-            lat=panos_lat,
-            lon=panos_lon,
-            n=panos_count,
-            radius_m=panos_area_of_interest,
-            min_distance_m=panos_min_distance
+        panos_combined_result = panos_future.result()
+        return Response(
+            iter_combined_result_json(
+                {k: str(v) for k, v in landcover_outputs.items()},
+                veg_result,
+                panos_combined_result
+            ),
+            mimetype='application/json'
         )
-        detected_objects = []
-        classify_results = []
-        for img in pano_result.get('images', []):
-            if img.get('pano_downloaded'):
-                pano_path = img.get('pano_path')
-                if pano_path and os.path.exists(pano_path):
-                    detect_result = run_object_detection(pano_path, panos_labels)
-                    detected_objects.append({
-                        'pano_id': img.get('id'),
-                        'pano_path': pano_path,
-                        'object_detection': detect_result
-                    })
-                    crop_dir = os.path.join(os.path.dirname(pano_path), '..', 'detected_crops')
-                    crop_dir = os.path.abspath(crop_dir)
-                    crop_images = glob.glob(os.path.join(crop_dir, '*.jpg'))
-                    crop_classifications = []
-                    for crop_img in crop_images:
-                        try:
-                            image = Image.open(crop_img)
-                            inputs = plant_processor(images=image, return_tensors="pt")
-                            with torch.no_grad():
-                                logits = plant_model(**inputs).logits
-                            pred = logits.softmax(dim=-1)[0]
-                            topk = torch.topk(pred, k=5)
-                            results = []
-                            for prob, idx in zip(topk.values, topk.indices):
-                                label = plant_model.config.id2label[idx.item()]
-                                results.append({"label": label, "probability": float(prob.item())})
-                            crop_classifications.append({
-                                "crop_image": crop_img,
-                                "classification": results
-                            })
-                        except Exception as e:
-                            crop_classifications.append({
-                                "crop_image": crop_img,
-                                "error": str(e)
-                            })
-                    classify_results.append({
-                        'pano_id': img.get('id'),
-                        'crop_classifications': crop_classifications
-                    })
-                else:
-                    detected_objects.append({
-                        'pano_id': img.get('id'),
-                        'pano_path': pano_path,
-                        'object_detection': 'Pano image not found.'
-                    })
-            else:
-                detected_objects.append({
-                    'pano_id': img.get('id'),
-                    'pano_path': img.get('pano_path'),
-                    'object_detection': 'Pano not downloaded.'
-                })
-        panos_combined_result = {
-            'pano_result': pano_result,
-            'detected_objects': detected_objects,
-            'classify_results': classify_results
-        }
-        return jsonify({
-            'landcover': {k: str(v) for k, v in landcover_outputs.items()},
-            'vegetation': veg_result,
-            'panos': panos_combined_result
-        })
     except Exception as e:
         return jsonify({'error': str(e), 'trace': traceback.format_exc()}), 500
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    app.run(host='0.0.0.0', port=5000, debug=True, threaded=True)
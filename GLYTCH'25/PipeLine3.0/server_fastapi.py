@@ -1,36 +1,52 @@
-import glob
+import asyncio
 import os
-import json
+import shutil
 import traceback
 import base64  # <--- Added for image encoding
+import copy
+import dataclasses
+import hashlib
+import hmac
+import multiprocessing
+import threading
+import time
+import uuid
 from pathlib import Path
 from typing import Optional, List, Dict, Any
 from datetime import datetime, timedelta
 from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor
 from fastapi.staticfiles import StaticFiles
 
-from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, Form, status
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, Form, Request, BackgroundTasks, status
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse, FileResponse, Response
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from passlib.context import CryptContext
 from jose import JWTError, jwt
+from cachetools import TTLCache
+import orjson
 
-from PIL import Image
+import numpy as np
 import torch
-from transformers import AutoImageProcessor, AutoModelForImageClassification
 
 from panos360Helper import *
 
 # Import database utilities
 from database import (
+    UPLOAD_DIR,
     init_db,
     get_connection,
+    write_transaction,
+    close_connection,
+    upload_file_name,
+    insert_uploads,
     generate_uuid,
     get_uploads_in_radius,
     get_user_score,
-    get_user_uploads
+    iter_user_uploads
 )
 
 # Import the landcover pipeline
@@ -41,6 +57,15 @@ from vegetation.Vegetation_Classification_pipeline import AOIConfig as VegAOICon
 # GoogleVR4 imports
 import GoogleVR4.core as core
 from GoogleVR4.ObjectIdentifier import run_object_detection
+from GoogleVR4.PlantIdentifier import (
+    DEVICE,
+    PLANT_BATCH_SIZE,
+    _get_plant_model,
+    classify_plant_batch,
+    classify_pano_crops,
+    detect_panos,
+    load_plant_images
+)
 
 # -----------------------------------------------------------------------------
 # Configuration
@@ -49,18 +74,102 @@ SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-change-in-production")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24  # 1 day
 
+# Output locations, resolved once instead of on every request. Named apart
+# from panos360Helper's BASE_DIR/OUT_DIR, which the star import brings in.
+SERVER_DIR = Path(__file__).resolve().parent
+RESULT_OUT_DIR = SERVER_DIR / "out"
+RESULT_OUT_DIR.mkdir(exist_ok=True)
+LANDCOVER_RESULTS_DIR = SERVER_DIR / "LandcoverResults"
+PANO360_OUTPUT_DIR = SERVER_DIR / "Pano360OutputDir"
+PANO360_OUTPUT_DIR.mkdir(exist_ok=True)
+
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 security = HTTPBearer()
 
-# Plant model for classification
-PLANT_MODEL_ID = "juppy44/plant-identification-2m-vit-b"
-DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-plant_processor = AutoImageProcessor.from_pretrained(PLANT_MODEL_ID)
-plant_model = AutoModelForImageClassification.from_pretrained(PLANT_MODEL_ID).to(DEVICE)
+# The caches below are per process. Under several uvicorn workers each one
+# fills and expires on its own, and /cache/clear or an upload's score_cache
+# invalidation only reaches the worker that handled that request; the others
+# serve their entries until the TTL runs out.
+# Credentials that passed bcrypt recently, so quick re-logins skip the hash.
+# Keys are HMACs with the server secret; failed attempts are never stored.
+login_cache: TTLCache = TTLCache(maxsize=1024, ttl=60)
+# Per-user upload counts for /auth/me; dropped when that user uploads
+score_cache: TTLCache = TTLCache(maxsize=4096, ttl=60)
+# Pano searches keyed on the rounded request. Only hits are kept, so a
+# Mapillary outage does not pin "no imagery" for the TTL.
+pano_search_cache: TTLCache = TTLCache(maxsize=128, ttl=600)
+# Each landcover run writes into its own run_* directory under the output dir,
+# so a cached entry's files are never overwritten by a later or failed run.
+landcover_cache: TTLCache = TTLCache(maxsize=8, ttl=3600)
+result_cache_lock = threading.Lock()
+
+# On CPU-only hosts, PLANT_CLASSIFY_WORKERS=N spreads classification over N
+# processes, each with its own model replica. 0 (the default) classifies
+# in-process; GPU hosts always do, since one batched model fills the device.
+PLANT_CLASSIFY_WORKERS = int(os.getenv("PLANT_CLASSIFY_WORKERS", "0")) if DEVICE.type == "cpu" else 0
+# uvicorn worker processes sharing this host, exported by the launcher at the
+# bottom of this file; each takes an even share of the cores for torch
+SERVER_WORKERS = max(1, int(os.getenv("UVICORN_WORKERS", "1")))
+TORCH_THREADS = max(1, (os.cpu_count() or 1) // SERVER_WORKERS)
+classify_pool: Optional[ProcessPoolExecutor] = None
 
 # -----------------------------------------------------------------------------
 # Helper Functions
 # -----------------------------------------------------------------------------
+def cached_find_panos_and_views(lat, lon, n=3, radius_m=100.0, min_distance_m=10.0, finder=None):
+    """finder (core.find_panos_and_views by default) memoized in pano_search_cache"""
+    finder = finder or core.find_panos_and_views
+    # ~0.1 m of rounding folds repeat requests for the same spot together; the
+    # finder still gets the exact coordinates, which its result echoes back
+    key = (finder.__module__, round(lat, 6), round(lon, 6), n, radius_m, min_distance_m)
+    with result_cache_lock:
+        result = pano_search_cache.get(key)
+    if result is None:
+        result = finder(lat=lat, lon=lon, n=n, radius_m=radius_m, min_distance_m=min_distance_m)
+        if result.get("found"):
+            with result_cache_lock:
+                pano_search_cache[key] = result
+    # Callers get their own copy so a handler can't edit the cached entry
+    return copy.deepcopy(result)
+
+def cached_run_landcover_pipeline(aoi_cfg: LandcoverAOIConfig, dl_cfg: DownloadConfig) -> Dict[str, Path]:
+    """run_landcover_pipeline memoized in landcover_cache on the config fields, each run in its own directory"""
+    key = dataclasses.astuple(aoi_cfg) + dataclasses.astuple(dl_cfg)
+    with result_cache_lock:
+        outputs = landcover_cache.get(key)
+    if outputs is None or not all(Path(v).exists() for v in outputs.values()):
+        _prune_landcover_runs(dl_cfg.output_dir)
+        run_dir = dl_cfg.output_dir / f"run_{uuid.uuid4().hex}"
+        try:
+            outputs = run_landcover_pipeline(aoi_cfg, dataclasses.replace(dl_cfg, output_dir=run_dir))
+        except Exception:
+            shutil.rmtree(run_dir, ignore_errors=True)
+            raise
+        # The latest mask is also published at the fixed path /run_vegetation
+        # defaults to; os.replace swaps it in whole for readers
+        staged = run_dir / "vegetation_mask.tif.publish"
+        shutil.copyfile(outputs["vegetation_mask"], staged)
+        os.replace(staged, dl_cfg.output_dir / "vegetation_mask.tif")
+        with result_cache_lock:
+            landcover_cache[key] = outputs
+    return dict(outputs)
+
+def _prune_landcover_runs(output_dir: Path) -> None:
+    """Delete run directories under output_dir that have outlived landcover_cache's TTL"""
+    cutoff = time.time() - landcover_cache.ttl
+    for run_dir in output_dir.glob("run_*"):
+        try:
+            if run_dir.stat().st_mtime < cutoff:
+                shutil.rmtree(run_dir, ignore_errors=True)
+        except FileNotFoundError:
+            pass  # another request pruned it first
+
+def write_result_json(path: Path, result: Dict[str, Any]) -> None:
+    """Save a pipeline result; endpoints queue this as a background task after responding"""
+    path.write_bytes(orjson.dumps(
+        result, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS, default=str
+    ))
+
 def image_to_base64(image_path: str) -> Optional[str]:
     """Reads an image file and converts it to a base64 string"""
     if not image_path or not os.path.exists(image_path):
@@ -72,6 +181,81 @@ def image_to_base64(image_path: str) -> Optional[str]:
         print(f"Error encoding image {image_path}: {e}")
         return None
 
+def _init_classify_worker(num_threads: int) -> None:
+    """classify_pool initializer: take a share of the cores and load the model once"""
+    torch.set_num_threads(num_threads)
+    _get_plant_model()
+
+def run_plant_classification(images: List[np.ndarray]) -> List[List[Dict[str, Any]]]:
+    """classify_plant_batch, fanned out over classify_pool a batch per worker when it is running"""
+    if classify_pool is None:
+        return classify_plant_batch(images)
+    chunks = [images[i:i + PLANT_BATCH_SIZE] for i in range(0, len(images), PLANT_BATCH_SIZE)]
+    return [result for chunk in classify_pool.map(classify_plant_batch, chunks) for result in chunk]
+
+class BatchInferencer:
+    """
+    Coalesces concurrent submit() calls into one batch_fn call.
+
+    A worker task waits for the first queued item, then keeps collecting until
+    max_batch_size items are queued or max_batch_delay seconds have passed.
+    batch_fn is blocking (list of items -> list of results), so it runs in the
+    threadpool; each caller gets its own result or the batch's exception.
+    """
+
+    def __init__(self, batch_fn, max_batch_size: int = 8, max_batch_delay: float = 0.01):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_batch_delay = max_batch_delay
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._queue = asyncio.Queue()
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+    async def submit(self, item):
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_batch_delay
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                results = await run_in_threadpool(self.batch_fn, [item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+# Merges concurrent /classify_plant requests into shared forward passes
+plant_batcher = BatchInferencer(run_plant_classification, max_batch_size=PLANT_BATCH_SIZE, max_batch_delay=0.01)
+
 # -----------------------------------------------------------------------------
 # Lifespan: Initialize DB on startup
 # -----------------------------------------------------------------------------
@@ -80,14 +264,34 @@ async def lifespan(app: FastAPI):
     # Startup: Initialize database
     init_db()
     print("✅ Database initialized and ready")
+    # Without this, every worker's torch would start one thread per core
+    torch.set_num_threads(TORCH_THREADS)
+    # Load the plant classifier now rather than on the first request
+    global classify_pool
+    if PLANT_CLASSIFY_WORKERS > 0:
+        # spawn, not fork: the parent already runs torch and executor threads
+        classify_pool = ProcessPoolExecutor(
+            max_workers=PLANT_CLASSIFY_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_classify_worker,
+            initargs=(max(1, TORCH_THREADS // PLANT_CLASSIFY_WORKERS),)
+        )
+    else:
+        _get_plant_model()
+    plant_batcher.start()
     yield
-    # Shutdown: cleanup if needed
-    pass
+    # Shutdown: stop the batcher and workers and release the pooled database connection
+    await plant_batcher.stop()
+    if classify_pool is not None:
+        classify_pool.shutdown(cancel_futures=True)
+        classify_pool = None
+    close_connection()
 
 app = FastAPI(
     title="AgniVed Pipeline & Upload API",
     version="2.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 # CORS
@@ -205,6 +409,11 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
 def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
 
+def login_cache_key(userid: str, password: str, hashed_password: str) -> str:
+    # Includes the stored hash so a changed password never matches an old entry
+    message = "\0".join((userid, password, hashed_password)).encode()
+    return hmac.new(SECRET_KEY.encode(), message, hashlib.sha256).hexdigest()
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -246,8 +455,9 @@ async def get_current_admin(current_user: dict = Depends(get_current_user)):
 # Auth Endpoints
 # -----------------------------------------------------------------------------
 @app.post("/auth/register")
-async def register(user: UserRegister):
+def register(user: UserRegister):
     """Register a new user"""
+    # Plain def: bcrypt and the write transaction both block, so this runs in the threadpool
     if user.role not in ["user", "admin"]:
         user.role = "user"
     
@@ -255,14 +465,11 @@ async def register(user: UserRegister):
     user_id = generate_uuid()
     
     try:
-        conn = get_connection()
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO users (id, userid, name, password_hash, role) VALUES (?, ?, ?, ?, ?)",
-            (user_id, user.userid, user.name, password_hash, user.role)
-        )
-        conn.commit()
-        conn.close()
+        with write_transaction() as conn:
+            conn.execute(
+                "INSERT INTO users (id, userid, name, password_hash, role) VALUES (?, ?, ?, ?, ?)",
+                (user_id, user.userid, user.name, password_hash, user.role)
+            )
         return {"message": "Registration successful", "userid": user.userid}
     except Exception as e:
         if "UNIQUE constraint failed" in str(e):
@@ -276,11 +483,16 @@ async def login(user: UserLogin):
     cur = conn.cursor()
     cur.execute("SELECT id, password_hash, role FROM users WHERE userid = ?", (user.userid,))
     db_user = cur.fetchone()
-    conn.close()
     
-    if not db_user or not verify_password(user.password, db_user["password_hash"]):
+    if not db_user:
         raise HTTPException(status_code=401, detail="Invalid username or password")
     
+    cache_key = login_cache_key(user.userid, user.password, db_user["password_hash"])
+    if cache_key not in login_cache:
+        if not verify_password(user.password, db_user["password_hash"]):
+            raise HTTPException(status_code=401, detail="Invalid username or password")
+        login_cache[cache_key] = True
+    
     user_id = db_user["id"]
     role = db_user["role"]
     
@@ -300,7 +512,9 @@ async def login(user: UserLogin):
 @app.get("/auth/me")
 async def get_me(current_user: dict = Depends(get_current_user)):
     """Get current user info"""
-    score = get_user_score(current_user["user_id"])
+    score = score_cache.get(current_user["user_id"])
+    if score is None:
+        score = score_cache[current_user["user_id"]] = get_user_score(current_user["user_id"])
     return {
         "userid": current_user["userid"],
         "role": current_user["role"],
@@ -310,6 +524,19 @@ async def get_me(current_user: dict = Depends(get_current_user)):
 # -----------------------------------------------------------------------------
 # Upload Endpoints
 # -----------------------------------------------------------------------------
+UPLOAD_COPY_CHUNK = 1024 * 1024  # 1 MiB
+
+def save_upload_file(src, dest: Path) -> None:
+    """Copy an upload to dest in chunks, renaming into place only once complete."""
+    tmp = dest.with_name(dest.name + ".part")
+    try:
+        with open(tmp, "wb") as f:
+            shutil.copyfileobj(src, f, UPLOAD_COPY_CHUNK)
+        os.replace(tmp, dest)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
 @app.post("/upload")
 async def upload_image(
     image: UploadFile = File(...),
@@ -322,23 +549,33 @@ async def upload_image(
     if not image.filename:
         raise HTTPException(status_code=400, detail="No image selected")
     
-    image_bytes = await image.read()
     filename = image.filename
     content_type = image.content_type
     upload_id = generate_uuid()
     user_id = current_user["user_id"]
     
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO uploads (id, user_id, filename, content_type, image, latitude, longitude, species)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """,
-        (upload_id, user_id, filename, content_type, image_bytes, latitude, longitude, species)
-    )
-    conn.commit()
-    conn.close()
+    # Copy the spooled upload straight to disk instead of holding it in memory,
+    # off the event loop since large files hit the disk
+    rel_path = upload_file_name(upload_id, filename)
+    image_path = UPLOAD_DIR / rel_path
+    await run_in_threadpool(save_upload_file, image.file, image_path)
+    
+    try:
+        # The insert waits on the database's single writer lock; keep it off the event loop
+        await run_in_threadpool(insert_uploads, [{
+            "id": upload_id,
+            "user_id": user_id,
+            "filename": filename,
+            "content_type": content_type,
+            "path": rel_path,
+            "latitude": latitude,
+            "longitude": longitude,
+            "species": species,
+        }])
+    except Exception:
+        image_path.unlink(missing_ok=True)  # Don't leave an orphaned file behind
+        raise
+    score_cache.pop(user_id, None)
     
     return {
         "message": "Upload successful",
@@ -349,11 +586,22 @@ async def upload_image(
         "species": species
     }
 
+async def stream_uploads_json(uploads):
+    # Async so the rows are pulled on the event loop thread, which owns the
+    # thread-local SQLite connection; iter_user_uploads pages its queries, so
+    # no statement stays open while the client reads
+    yield b'{"uploads":['
+    sep = b""
+    for upload in uploads:
+        yield sep + orjson.dumps(upload)
+        sep = b","
+    yield b"]}"
+
 @app.get("/uploads/me")
 async def get_my_uploads(current_user: dict = Depends(get_current_user), limit: Optional[int] = None):
     """Get all uploads by current user"""
-    uploads = get_user_uploads(current_user["user_id"], limit)
-    return {"uploads": uploads}
+    uploads = iter_user_uploads(current_user["user_id"], limit)
+    return StreamingResponse(stream_uploads_json(uploads), media_type="application/json")
 
 @app.post("/uploads/search")
 async def search_uploads(req: UploadSearchRequest, current_user: dict = Depends(get_current_user)):
@@ -371,21 +619,34 @@ async def search_uploads(req: UploadSearchRequest, current_user: dict = Depends(
     }
 
 @app.get("/image/{image_id}")
-async def get_image(image_id: str, current_user: dict = Depends(get_current_user)):
+async def get_image(image_id: str, request: Request, current_user: dict = Depends(get_current_user)):
     """Get an uploaded image by ID"""
     conn = get_connection()
     cur = conn.cursor()
     
     # Allow any authenticated user to view the image (removed 'AND user_id = ?')
-    cur.execute("SELECT image, content_type FROM uploads WHERE id = ?", (image_id,))
+    cur.execute("SELECT path, content_type FROM uploads WHERE id = ?", (image_id,))
     
     result = cur.fetchone()
-    conn.close()
     
     if not result:
         raise HTTPException(status_code=404, detail="Image not found")
     
-    return StreamingResponse(iter([result["image"]]), media_type=result["content_type"])
+    # An upload's bytes never change, so its id is a valid strong ETag and
+    # browsers can revalidate without the file being read
+    headers = {
+        "ETag": f'"{image_id}"',
+        "Cache-Control": "private, max-age=86400, immutable",
+    }
+    if_none_match = request.headers.get("if-none-match", "")
+    if headers["ETag"] in if_none_match or if_none_match.strip() == "*":
+        return Response(status_code=304, headers=headers)
+    
+    image_path = UPLOAD_DIR / result["path"]
+    if not image_path.is_file():
+        raise HTTPException(status_code=404, detail="Image file missing")
+    
+    return FileResponse(image_path, media_type=result["content_type"], headers=headers)
 # -----------------------------------------------------------------------------
 # Pipeline Endpoints (unchanged from original, but now protected)
 # -----------------------------------------------------------------------------
@@ -393,65 +654,49 @@ async def get_image(image_id: str, current_user: dict = Depends(get_current_user
 async def root():
     return {"message": "AgniVed Pipeline API - Use /docs for API documentation"}
 
+@app.post("/cache/clear")
+async def clear_result_caches(current_admin: dict = Depends(get_current_admin)):
+    """Drop memoized pano searches and landcover runs (admin only)"""
+    with result_cache_lock:
+        cleared = {"pano_search": len(pano_search_cache), "landcover": len(landcover_cache)}
+        pano_search_cache.clear()
+        landcover_cache.clear()
+    return {"cleared": cleared}
+
+# The pipeline endpoints below block on Mapillary downloads and model inference,
+# so they are plain functions: FastAPI runs them in its threadpool instead of
+# stalling the event loop for every other request.
 @app.post('/panos')
-async def panos_api(request: PanosRequest, current_user: dict = Depends(get_current_user)):
-    result = core.find_panos_and_views(
+def panos_api(request: PanosRequest, background_tasks: BackgroundTasks, current_user: dict = Depends(get_current_user)):
+    result = cached_find_panos_and_views(
         lat=request.lat,
         lon=request.lon,
         n=request.count,
         radius_m=request.area_of_interest,
         min_distance_m=request.min_distance
     )
-    out_dir = os.path.join(os.path.dirname(__file__), 'out')
-    os.makedirs(out_dir, exist_ok=True)
-    result_path = os.path.join(out_dir, 'panos_result.json')
-    with open(result_path, 'w', encoding='utf-8') as f:
-        json.dump(result, f, indent=2)
+    result_path = RESULT_OUT_DIR / 'panos_result.json'
+    background_tasks.add_task(write_result_json, result_path, result)
     return result
 
 @app.post('/detect_objects')
-async def detect_objects_api(request: DetectObjectsRequest, current_user: dict = Depends(get_current_user)):
+def detect_objects_api(request: DetectObjectsRequest, current_user: dict = Depends(get_current_user)):
     result = run_object_detection(request.image_path, request.labels)
     return result
 
 @app.post('/panos_detect_objects')
-async def panos_detect_objects_api(request: PanosDetectObjectsRequest, current_user: dict = Depends(get_current_user)):
-    pano_result = core.find_panos_and_views(
+def panos_detect_objects_api(request: PanosDetectObjectsRequest, background_tasks: BackgroundTasks, current_user: dict = Depends(get_current_user)):
+    pano_result = cached_find_panos_and_views(
         lat=request.lat,
         lon=request.lon,
         n=request.count,
         radius_m=request.area_of_interest,
         min_distance_m=request.min_distance
     )
-    out_dir = os.path.join(os.path.dirname(__file__), 'out')
-    os.makedirs(out_dir, exist_ok=True)
-    result_path = os.path.join(out_dir, 'panos_detect_objects_result.json')
-    with open(result_path, 'w', encoding='utf-8') as f:
-        json.dump(pano_result, f, indent=2)
-
-    detected_objects = []
-    for img in pano_result.get('images', []):
-        if img.get('pano_downloaded'):
-            pano_path = img.get('pano_path')
-            if pano_path and os.path.exists(pano_path):
-                detect_result = run_object_detection(pano_path, request.labels)
-                detected_objects.append({
-                    'pano_id': img.get('id'),
-                    'pano_path': pano_path,
-                    'object_detection': detect_result
-                })
-            else:
-                detected_objects.append({
-                    'pano_id': img.get('id'),
-                    'pano_path': pano_path,
-                    'object_detection': 'Pano image not found.'
-                })
-        else:
-            detected_objects.append({
-                'pano_id': img.get('id'),
-                'pano_path': img.get('pano_path'),
-                'object_detection': 'Pano not downloaded.'
-            })
+    result_path = RESULT_OUT_DIR / 'panos_detect_objects_result.json'
+    background_tasks.add_task(write_result_json, result_path, pano_result)
+
+    detected_objects = [entry for entry, _ in detect_panos(pano_result.get('images', []), request.labels)]
 
     combined_result = {
         'pano_result': pano_result,
@@ -464,121 +709,56 @@ async def classify_plant_api(request: ClassifyPlantRequest, current_user: dict =
     if not request.image_path or not os.path.exists(request.image_path):
         raise HTTPException(status_code=400, detail="image_path not provided or file does not exist")
     try:
-        image = Image.open(request.image_path)
-        inputs = plant_processor(images=image, return_tensors="pt")
-        with torch.no_grad():
-            logits = plant_model(**inputs).logits
-        pred = logits.softmax(dim=-1)[0]
-        topk = torch.topk(pred, k=5)
-        results = []
-        for prob, idx in zip(topk.values, topk.indices):
-            label = plant_model.config.id2label[idx.item()]
-            results.append({"label": label, "probability": float(prob.item())})
+        # Decode in the threadpool; inference is batched with other requests
+        image = (await run_in_threadpool(load_plant_images, [request.image_path]))[0]
+        if isinstance(image, Exception):
+            raise image
+        results = await plant_batcher.submit(image)
         return {"results": results}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post('/panos_detect_and_classify')
-async def panos_detect_and_classify_api(request: PanosDetectAndClassifyRequest, current_user: dict = Depends(get_current_user)):
-    pano_result = core.find_panos_and_views(
+async def panos_detect_and_classify_api(request: PanosDetectAndClassifyRequest, background_tasks: BackgroundTasks, current_user: dict = Depends(get_current_user)):
+    # Async: the pano search, detection and classification each run in the threadpool
+    pano_result = await run_in_threadpool(
+        cached_find_panos_and_views,
         lat=request.lat,
         lon=request.lon,
         n=request.count,
         radius_m=request.area_of_interest,
         min_distance_m=request.min_distance
     )
-    out_dir = os.path.join(os.path.dirname(__file__), 'out')
-    os.makedirs(out_dir, exist_ok=True)
-    result_path = os.path.join(out_dir, 'panos_detect_and_classify_result.json')
-
-    detected_objects = []
-    classify_results = []
-
-    for img in pano_result.get('images', []):
-        if img.get('pano_downloaded'):
-            pano_path = img.get('pano_path')
-            if pano_path and os.path.exists(pano_path):
-                detect_result = run_object_detection(pano_path, request.labels)
-                detected_objects.append({
-                    'pano_id': img.get('id'),
-                    'pano_path': pano_path,
-                    'object_detection': detect_result
-                })
+    result_path = RESULT_OUT_DIR / 'panos_detect_and_classify_result.json'
 
-                crop_dir = os.path.join(os.path.dirname(pano_path), '..', 'detected_crops')
-                crop_dir = os.path.abspath(crop_dir)
-                crop_images = glob.glob(os.path.join(crop_dir, '*.jpg'))
-                crop_classifications = []
-                for crop_img in crop_images:
-                    try:
-                        image = Image.open(crop_img)
-                        inputs = plant_processor(images=image, return_tensors="pt")
-                        with torch.no_grad():
-                            logits = plant_model(**inputs).logits
-                        pred = logits.softmax(dim=-1)[0]
-                        topk = torch.topk(pred, k=5)
-                        results = []
-                        for prob, idx in zip(topk.values, topk.indices):
-                            label = plant_model.config.id2label[idx.item()]
-                            results.append({"label": label, "probability": float(prob.item())})
-                        crop_classifications.append({
-                            "crop_image": crop_img,
-                            "classification": results
-                        })
-                    except Exception as e:
-                        crop_classifications.append({
-                            "crop_image": crop_img,
-                            "error": str(e)
-                        })
-                classify_results.append({
-                    'pano_id': img.get('id'),
-                    'crop_classifications': crop_classifications
-                })
-            else:
-                detected_objects.append({
-                    'pano_id': img.get('id'),
-                    'pano_path': pano_path,
-                    'object_detection': 'Pano image not found.'
-                })
-        else:
-            detected_objects.append({
-                'pano_id': img.get('id'),
-                'pano_path': img.get('pano_path'),
-                'object_detection': 'Pano not downloaded.'
-            })
+    processed = await run_in_threadpool(detect_panos, pano_result.get('images', []), request.labels)
+    detected_objects = [entry for entry, _ in processed]
+    classify_results = await run_in_threadpool(classify_pano_crops, processed, run_plant_classification)
 
     combined_result = {
         'pano_result': pano_result,
         'detected_objects': detected_objects,
         'classify_results': classify_results
     }
-    with open(result_path, 'w', encoding='utf-8') as f:
-        json.dump(combined_result, f, indent=2)
+    background_tasks.add_task(write_result_json, result_path, combined_result)
     return combined_result
 
 @app.post('/run_landcover')
-async def run_landcover(request: LandcoverRequest, current_user: dict = Depends(get_current_user)):
+def run_landcover(request: LandcoverRequest, current_user: dict = Depends(get_current_user)):
     try:
-        parent_dir = Path(__file__).resolve().parent
-        results_dir = parent_dir / "LandcoverResults"
         aoi_cfg = LandcoverAOIConfig(lon=request.lon, lat=request.lat, buffer_km=request.buffer_km)
         dl_cfg = DownloadConfig(
-            output_dir=results_dir,
+            output_dir=LANDCOVER_RESULTS_DIR,
             date_start=request.date_start,
             date_end=request.date_end,
             scale=request.scale,
             cloud_cover_max=request.cloud_cover_max,
         )
-        outputs = run_landcover_pipeline(aoi_cfg, dl_cfg)
+        outputs = cached_run_landcover_pipeline(aoi_cfg, dl_cfg)
         
         # --- FIX: Convert visual output to Base64 ---
-        viz_path = outputs.get('viz_path')
-        if not viz_path:
-             potential_path = results_dir / "agnived_cover_analysis.png"
-             if potential_path.exists():
-                 viz_path = str(potential_path)
-
-        b64_string = image_to_base64(str(viz_path))
+        # The run's own copy; the fixed LandcoverResults path is not written anymore
+        b64_string = image_to_base64(str(outputs['visualization']))
         
         return {
             **{k: str(v) for k, v in outputs.items()},
@@ -588,12 +768,11 @@ async def run_landcover(request: LandcoverRequest, current_user: dict = Depends(
         raise HTTPException(status_code=500, detail={'error': str(e), 'trace': traceback.format_exc()})
 
 @app.post('/run_vegetation')
-async def run_vegetation(request: VegetationRequest, current_user: dict = Depends(get_current_user)):
+def run_vegetation(request: VegetationRequest, current_user: dict = Depends(get_current_user)):
     try:
         mask_path = request.mask_path
         if not mask_path:
-            parent_dir = Path(__file__).resolve().parent
-            mask_path = str(parent_dir / "LandcoverResults" / "vegetation_mask.tif")
+            mask_path = str(LANDCOVER_RESULTS_DIR / "vegetation_mask.tif")
         
         aoi_cfg = VegAOIConfig(lon=request.lon, lat=request.lat, buffer_km=request.buffer_km)
         res = run_bigearth_rdnet(aoi_cfg, veg_mask_path=Path(mask_path))
@@ -603,7 +782,6 @@ async def run_vegetation(request: VegetationRequest, current_user: dict = Depend
 
         result = {
             'aoi': vars(res.aoi) if hasattr(res.aoi, '__dict__') else str(res.aoi),
-            'cube_path': str(res.cube_path),
             'viz_path': str(res.viz_path),
             'class_distribution': res.class_distribution,
             'tile_counts': res.tile_counts,
@@ -623,7 +801,7 @@ async def run_vegetation(request: VegetationRequest, current_user: dict = Depend
 #         results_dir = parent_dir / "LandcoverResults"
 #         aoi_cfg = LandcoverAOIConfig(lon=request.lon, lat=request.lat, buffer_km=request.buffer_km)
 #         dl_cfg = DownloadConfig(
-#             output_dir=results_dir,
+#             output_dir=LANDCOVER_RESULTS_DIR,
 #             date_start=request.date_start,
 #             date_end=request.date_end,
 #             scale=request.scale,
@@ -669,7 +847,7 @@ async def run_vegetation(request: VegetationRequest, current_user: dict = Depend
 #         results_dir = parent_dir / "LandcoverResults"
 #         aoi_cfg = LandcoverAOIConfig(lon=request.lon, lat=request.lat, buffer_km=request.buffer_km)
 #         dl_cfg = DownloadConfig(
-#             output_dir=results_dir,
+#             output_dir=LANDCOVER_RESULTS_DIR,
 #             date_start=request.date_start,
 #             date_end=request.date_end,
 #             scale=request.scale,
@@ -775,7 +953,7 @@ async def run_vegetation(request: VegetationRequest, current_user: dict = Depend
 
 
 @app.post('/run_panos_and_plant_identification')
-async def run_panos_and_plant_identification(request: LandcoverVegetationPanosRequest):
+def run_panos_and_plant_identification(request: LandcoverVegetationPanosRequest, background_tasks: BackgroundTasks):
     """
     Fast pipeline: Panos + Object Detection + Plant Identification for all detected crops
     Skips landcover and vegetation analysis - focuses only on street-level imagery analysis
@@ -786,22 +964,29 @@ async def run_panos_and_plant_identification(request: LandcoverVegetationPanosRe
         panos_lat = request.panos_lat if request.panos_lat is not None else request.lat
         panos_lon = request.panos_lon if request.panos_lon is not None else request.lon
         
-        pano_result = find_panos_and_views(
+        pano_result = cached_find_panos_and_views(
             lat=panos_lat,
             lon=panos_lon,
             n=request.panos_count,
             radius_m=request.panos_area_of_interest,
-            min_distance_m=request.panos_min_distance
+            min_distance_m=request.panos_min_distance,
+            finder=find_panos_and_views
         )
         
         detected_objects = []
         plant_identification_results = []
+        # The detector hands over each crop as it saves it, so the classifier
+        # gets the pixels without decoding the JPEG back from disk
+        crop_arrays = {}
+        
+        def keep_crop(crop_path, crop):
+            crop_arrays[os.path.abspath(crop_path)] = np.asarray(crop)
         
         for img in pano_result.get('images', []):
             if img.get('pano_downloaded'):
                 pano_path = img.get('pano_path')
                 if pano_path and os.path.exists(pano_path):
-                    detect_result = run_object_detection(pano_path, request.panos_labels)
+                    detect_result = run_object_detection(pano_path, request.panos_labels, on_crop=keep_crop)
                     
                     # Encode panorama image to base64
                     pano_base64 = image_to_base64(pano_path)
@@ -816,8 +1001,8 @@ async def run_panos_and_plant_identification(request: LandcoverVegetationPanosRe
                     # Get crop images from the detection result
                     crops = detect_result.get('crops', [])
                     crop_plant_identifications = []
+                    pending = []  # (slot, crop_info, crop_path) for crops found on disk
                     
-                    # Run identify_plant for each detected crop
                     for crop_info in crops:
                         crop_path = crop_info.get('crop_path')
                         if not crop_path:
@@ -836,46 +1021,46 @@ async def run_panos_and_plant_identification(request: LandcoverVegetationPanosRe
                             })
                             continue
                         
-                        try:
-                            # Call identify_plant logic for this crop
-                            image = Image.open(crop_path)
-                            inputs = plant_processor(images=image, return_tensors="pt")
-                            # Move inputs to the same device as the model
-                            inputs = {key: val.to(plant_model.device) for key, val in inputs.items()}
-                            with torch.no_grad():
-                                logits = plant_model(**inputs).logits
-                            pred = logits.softmax(dim=-1)[0]
-                            topk = torch.topk(pred, k=5)
-                            predictions = []
-                            for prob, idx in zip(topk.values, topk.indices):
-                                label = plant_model.config.id2label[idx.item()]
-                                predictions.append({
-                                    "species": label,
-                                    "confidence": float(prob.item()),
-                                    "confidence_percentage": f"{prob.item() * 100:.2f}%"
-                                })
-                            
-                            # Encode crop image to base64
-                            crop_base64 = image_to_base64(crop_path)
-                            
-                            # Plant identification result with species info and base64 image
-                            plant_id_result = {
+                        # Placeholder keeps the crop's position; filled in below
+                        crop_plant_identifications.append(None)
+                        pending.append((len(crop_plant_identifications) - 1, crop_info, crop_path))
+                    
+                    # Identify all of this pano's crops in batched forward passes
+                    unseen = [crop_path for _, _, crop_path in pending if crop_path not in crop_arrays]
+                    decoded = dict(zip(unseen, load_plant_images(unseen)))
+                    images = [crop_arrays.get(crop_path, decoded.get(crop_path)) for _, _, crop_path in pending]
+                    readable = [i for i, image in enumerate(images) if not isinstance(image, Exception)]
+                    try:
+                        batch_results = dict(zip(readable, run_plant_classification([images[i] for i in readable])))
+                    except Exception as e:
+                        batch_results = {i: e for i in readable}
+                    
+                    for i, (slot, crop_info, crop_path) in enumerate(pending):
+                        result = batch_results.get(i, images[i])
+                        if isinstance(result, Exception):
+                            crop_plant_identifications[slot] = {
                                 "crop_image": crop_path,
-                                "crop_image_base64": crop_base64,
                                 "object_label": crop_info.get('label'),
                                 "object_score": crop_info.get('score'),
-                                "predictions": predictions,
-                                "top_prediction": predictions[0] if predictions else None
+                                "error": str(result)
                             }
-                            crop_plant_identifications.append(plant_id_result)
-                            
-                        except Exception as e:
-                            crop_plant_identifications.append({
-                                "crop_image": crop_path,
-                                "object_label": crop_info.get('label'),
-                                "object_score": crop_info.get('score'),
-                                "error": str(e)
-                            })
+                            continue
+                        
+                        predictions = [{
+                            "species": pred["label"],
+                            "confidence": pred["probability"],
+                            "confidence_percentage": f"{pred['probability'] * 100:.2f}%"
+                        } for pred in result]
+                        
+                        # Plant identification result with species info and base64 image
+                        crop_plant_identifications[slot] = {
+                            "crop_image": crop_path,
+                            "crop_image_base64": image_to_base64(crop_path),
+                            "object_label": crop_info.get('label'),
+                            "object_score": crop_info.get('score'),
+                            "predictions": predictions,
+                            "top_prediction": predictions[0] if predictions else None
+                        }
                     
                     plant_identification_results.append({
                         'pano_id': img.get('id'),
@@ -923,11 +1108,8 @@ async def run_panos_and_plant_identification(request: LandcoverVegetationPanosRe
         }
         
         # Save result to Pano360OutputDir/panos_and_plant_identification_result.json
-        out_dir = os.path.join(os.path.dirname(__file__), 'Pano360OutputDir')
-        os.makedirs(out_dir, exist_ok=True)
-        result_path = os.path.join(out_dir, 'panos_and_plant_identification_result.json')
-        with open(result_path, 'w', encoding='utf-8') as f:
-            json.dump(result, f, indent=2)
+        result_path = PANO360_OUTPUT_DIR / 'panos_and_plant_identification_result.json'
+        background_tasks.add_task(write_result_json, result_path, result)
         
         return result
     except Exception as e:
@@ -937,4 +1119,24 @@ async def run_panos_and_plant_identification(request: LandcoverVegetationPanosRe
 
 if __name__ == '__main__':
     import uvicorn
-    uvicorn.run("server_fastapi:app", host='0.0.0.0', port=5000, reload=True)
\ No newline at end of file
+    # Each worker is its own process and runs the lifespan, so it loads its own
+    # plant ViT and Grounding DINO. GPU hosts default to one worker per GPU;
+    # CPU hosts to a single worker, since replicas there only split the same
+    # cores (PLANT_CLASSIFY_WORKERS parallelises classification instead).
+    # UVICORN_RELOAD=1 gives the single-process dev server back.
+    if os.getenv("UVICORN_RELOAD", "0") != "0":
+        uvicorn.run("server_fastapi:app", host='0.0.0.0', port=5000, reload=True)
+    else:
+        default_workers = torch.cuda.device_count() if DEVICE.type == "cuda" else 1
+        workers = max(1, int(os.getenv("UVICORN_WORKERS", default_workers)))
+        # Workers inherit the environment, which is how they learn their core share
+        os.environ["UVICORN_WORKERS"] = str(workers)
+        uvicorn.run(
+            "server_fastapi:app",
+            host='0.0.0.0',
+            port=5000,
+            workers=workers,
+            # uvloop / httptools when installed (uvicorn[standard]), else asyncio / h11
+            loop="auto",
+            http="auto",
+        )
\ No newline at end of file
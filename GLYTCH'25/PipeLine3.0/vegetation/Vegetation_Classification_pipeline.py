@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+import os
+import tempfile
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Dict, Tuple, List
@@ -107,7 +109,9 @@ class BigEarthConfig:
 @dataclass
 class BigEarthResult:
     aoi: AOIConfig
-    cube_path: Path
+    # None when run_bigearth_rdnet downloaded the cube itself; that temp file
+    # is deleted once read
+    cube_path: Path | None
     viz_path: Path
     class_distribution: Dict[str, float]
     tile_counts: Dict[str, int]
@@ -224,22 +228,45 @@ def build_single_composite(aoi: ee.Geometry, cfg: BigEarthConfig) -> ee.Image:
 
 def download_composite(img: ee.Image, aoi: ee.Geometry, cfg: BigEarthConfig) -> Path:
     cfg.temp_dir.mkdir(parents=True, exist_ok=True)
-    out_tif = cfg.temp_dir / "bigearth_s2_stack.tif"
-
-    url = img.getDownloadURL(
-        {
-            "scale": cfg.scale,
-            "region": aoi,
-            "filePerBand": False,
-            "format": "GEO_TIFF",
-        }
-    )
-    with requests.get(url, stream=True) as resp, open(out_tif, "wb") as f:
-        for chunk in resp.iter_content(chunk_size=8192):
-            f.write(chunk)
+    # A unique file per call, so concurrent requests never share a cube
+    fd, name = tempfile.mkstemp(prefix="bigearth_s2_stack_", suffix=".tif", dir=cfg.temp_dir)
+    out_tif = Path(name)
+
+    try:
+        with os.fdopen(fd, "wb") as f:
+            url = img.getDownloadURL(
+                {
+                    "scale": cfg.scale,
+                    "region": aoi,
+                    "filePerBand": False,
+                    "format": "GEO_TIFF",
+                }
+            )
+            with requests.get(url, stream=True) as resp:
+                for chunk in resp.iter_content(chunk_size=8192):
+                    f.write(chunk)
+    except BaseException:
+        out_tif.unlink(missing_ok=True)
+        raise
     return out_tif
 
 
+def fetch_bigearth_cube(aoi_cfg: AOIConfig, be_cfg: BigEarthConfig | None = None) -> Path:
+    """Download the Sentinel‑2 composite that run_bigearth_rdnet classifies.
+
+    It does not depend on the vegetation mask, so callers that also run the
+    landcover pipeline can fetch it concurrently and pass it as cube_path.
+    The file is unique to this call and belongs to the caller, who deletes
+    it once run_bigearth_rdnet has returned.
+    """
+    if be_cfg is None:
+        be_cfg = BigEarthConfig()
+    init_earth_engine()
+    aoi = build_aoi(aoi_cfg)
+    img = build_single_composite(aoi, be_cfg)
+    return download_composite(img, aoi, be_cfg)
+
+
 def read_cube(path: Path) -> np.ndarray:
     with rasterio.open(path) as src:
         data = src.read()
@@ -304,6 +331,7 @@ def run_bigearth_rdnet(
     device: torch.device | None = None,
     out_dir: Path | None = None,
     veg_mask_path: Path | None = None,
+    cube_path: Path | None = None,
 ) -> BigEarthResult:
     if be_cfg is None:
         be_cfg = BigEarthConfig()
@@ -313,12 +341,15 @@ def run_bigearth_rdnet(
         out_dir = SCRIPT_DIR / "Results"
     out_dir.mkdir(parents=True, exist_ok=True)
 
-    init_earth_engine()
-    aoi = build_aoi(aoi_cfg)
-    img = build_single_composite(aoi, be_cfg)
-    cube_path = download_composite(img, aoi, be_cfg)
-
-    s2_cube = read_cube(cube_path)
+    if cube_path is None:
+        # Downloaded here, so removed here: the cube lives in memory from now on
+        downloaded = fetch_bigearth_cube(aoi_cfg, be_cfg)
+        try:
+            s2_cube = read_cube(downloaded)
+        finally:
+            downloaded.unlink(missing_ok=True)
+    else:
+        s2_cube = read_cube(cube_path)
     _, H, W = s2_cube.shape
 
     mask = None